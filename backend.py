@@ -1,32 +1,129 @@
+import json
 import pickle
 import re
-import yaml
+from bisect import bisect_right
 from browser_cookie3 import chrome
-from bs4 import BeautifulSoup
-from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from html.parser import HTMLParser
 from http.cookiejar import CookieJar
+from journal import RunJournal
 from loguru import logger
+from metrics import MetricsStore, aggregate, weighted_sum
 from os import path
+from pipeline import BatchWriter, Stage
 from pygsheets import authorize
-from requests import get, post
+from pygsheets.custom_types import DateTimeRenderOption, ValueRenderOption
+from pygsheets.utils import format_addr
+from ratelimit import RateGovernor
+from request_builder import RequestTemplate
+from response_cache import ResponseCache
+from requests import Session
+from requests.adapters import HTTPAdapter
+from store import StateStore
+from threading import Lock, Thread
 from time import time
+from urllib.parse import urlencode
+from xml.etree import ElementTree
 
 
-class Backend:
+def date_range(date_from, date_to):
+	'''Returns a list of days from date_from to date_to inclusive'''
+	return [date_from + timedelta(days=n) for n in range((date_to - date_from).days + 1)]
+
+
+class RunCancelled(Exception):
+	'''Raised when a running backend process is cancelled by the user'''
+
+
+class _RootTagParser(HTMLParser):
+	'''Remembers attributes of the <html> tag and ignores the rest'''
 
 	def __init__(self):
+		super().__init__()
+		self.root_attrs = None
+
+	def handle_starttag(self, tag, attrs):
+		if tag == 'html' and self.root_attrs is None:
+			self.root_attrs = dict(attrs)
+
+
+class Backend:
+
+	# ads.getStatistics accepts up to 2000 ids, 'execute' runs up to 25 calls
+	VK_MAX_IDS = 2000
+	VK_EXECUTE_LIMIT = 25
+	# Longer VK requests are sent by POST
+	VK_MAX_GET_LENGTH = 2000
+
+	# Cookie domains sent by each session. VK API and FB Graph API are 
+	# authorized with access tokens, CBR needs no cookies at all
+	SESSION_DOMAINS = {
+		'Вконтакте': (),
+		'Facebook': (),
+		'Facebook Ads Manager': ('facebook.com',),
+		'MyTarget': ('my.com',),
+		'CBR': ()
+	}
+
+	# Default request rates (per second), bursts and concurrency limits
+	RATE_LIMITS = {
+		'Вконтакте': {'rate': 3, 'burst': 3, 'max_concurrency': 1},
+		'Facebook': {'rate': 4, 'burst': 4, 'max_concurrency': 4},
+		'MyTarget': {'rate': 4, 'burst': 4, 'max_concurrency': 4},
+		'Google Sheets': {'rate': 1, 'burst': 5, 'max_concurrency': 2},
+		'CBR': {'rate': 5, 'burst': 5, 'max_concurrency': 2}
+	}
+
+	# Error codes meaning that requests are too frequent
+	VK_THROTTLE_CODES = {6, 9, 29}
+	FB_THROTTLE_CODES = {4, 17, 32, 613} | set(range(80000, 80015))
+
+	# Internal CBR currency codes used by XML_dynamic.asp
+	CBR_CURRENCY_IDS = {'USD': 'R01235', 'EUR': 'R01239'}
+
+	# Platform requests compiled from the config: (platform, request) -> 
+	# method, url and per request keys. Per request keys used to be saved 
+	# to the config, they are dropped from it when templates are compiled
+	REQUEST_TEMPLATES = {
+		('Facebook', 'authorize'): (
+			'get', 'https://business.facebook.com/adsmanager/manage/campaigns', ()
+		),
+		('Facebook', 'get_campaign_data'): (
+			'get', 'https://graph.facebook.com/v7.0/act_{client_id}/am_tabular', 
+			('access_token', '_sessionID', 'filtering', 'time_range', '_')
+		),
+		('MyTarget', 'get_client_id'): (
+			'get', 'https://target.my.com/dashboard', ('sudo', '_')
+		),
+		('MyTarget', 'get_ad_data'): (
+			'get', 'https://target.my.com/api/v3/statistics/campaigns/day.json',
+			('X-Target-Sudo', 'Referer', 'id', 'date_from', 'date_to', 'adv_user', '_')
+		)
+	}
+
+	# Growing or often changing parts of the config are kept key by key 
+	# in their own namespaces of the state store: {namespace: (section, key)}
+	STORE_NAMESPACES = {
+		'credentials': ('Facebook', 'creds'),
+		'vk_day_stats': ('Вконтакте', 'day_stats'),
+		'cbr_rates': ('CBR', 'rates'),
+		'mt_client_ids': ('MyTarget', 'client_internal_ids')
+	}
+
+	def __init__(self, warm_up=True):
 		self.path_to_config = path.join('..', 'config', 'backend_config.yml')
 		self.path_to_cookies_temp = path.join('..', 'config', 'cookies.pickle')
+		self.path_to_client_secret = path.join('..', 'config', 'client_secret.json')
+		self.store = StateStore(path.join('..', 'config', 'state.db'))
 		self.config = self.load_config()
+		self.templates = self._compile_templates()
 
-		self.gc = authorize(client_secret=path.join('..', 'config', 'client_secret.json'))
+		# Google authorization, spreadsheet and browser cookies are slow to get,
+		# so they are created on first use (see gc, gs, ws and cj properties)
+		self._resources = {}
+		self._resource_locks = {name: Lock() for name in ['gc', 'gs', 'ws', 'cj']}
 
-		# We make sure in the GUI part that all necessary settings are made 
-		if 'GS' in self.config:
-			self.gs = self.gc.open_by_key(self.config['GS']['spreadsheet_id'])
-			self.ws = self.gs.worksheet_by_title(self.config['GS']['sheet_name'])
-
-		self.cj = self._get_cookies()
 		self.today_date = date.today().strftime("%d.%m.%Y")
 		self.current_month = date.today().strftime("%Y-%m")
 		self.platforms = ['Вконтакте', 'Facebook', 'MyTarget']
@@ -37,9 +134,119 @@ class Backend:
 			'MyTarget': self.process_mt
 
 		}
-		self.data_to_write = {}
-		# Separate dict for user report
-		self.result_data = {}
+		# Collected data of the run, read both by the writer and the user report
+		self.metrics = MetricsStore()
+		# Cell changes made (or to be made in dry run) by the last write
+		self.last_diff = []
+		# Progress callback and cancel event of the current run
+		self._progress = None
+		self._cancel = None
+		# Normalization stage of the running pipeline, gets merged results
+		self._normalizer = None
+
+		# Concurrency settings: platforms run simultaneously, each one is 
+		# allowed to use up to 'workers' threads for its own requests
+		run_config = self.config.get('run', {})
+		self.concurrent = run_config.get('concurrent', True)
+		self.pf_workers = {'Вконтакте': 1, 'Facebook': 4, 'MyTarget': 4}
+		self.pf_workers.update(run_config.get('workers', {}))
+
+		# Keep-alive HTTP sessions are shared by all requests to a platform
+		self.pool_sizes = run_config.get('pool_sizes', {})
+		self._sessions = {}
+		self._sessions_lock = Lock()
+
+		# Request rate of every platform is governed separately
+		self.rate_limits = dict(self.RATE_LIMITS)
+		for name, limits in run_config.get('rate_limits', {}).items():
+			self.rate_limits[name] = dict(self.rate_limits.get(name, {}), **limits)
+		self._governors = {}
+		self._governors_lock = Lock()
+
+		# Responses of platforms are cached on disk
+		cache_config = self.config.get('cache', {})
+		self.response_cache = ResponseCache(
+			path.join('..', 'config', 'cache'),
+			ttl=cache_config.get('ttl', 900),
+			max_entries=cache_config.get('max_entries', 5000)
+		)
+
+		# Campaign progress is journaled, so an interrupted run can be resumed
+		self.journal = RunJournal(path.join('..', 'config', 'run_journal.jsonl'))
+		# {(platform, campaign_id): journal key} of the current run
+		self._journal_keys = {}
+		# {row: (platform, campaign_id)} rows of the sheet taken during the run
+		self._row_owners = {}
+
+		# FB credentials may be refreshed by a background thread
+		self._fb_creds_lock = Lock()
+		self._fb_creds_thread = None
+		# Set when getting FB credentials failed during the current run
+		self._fb_creds_failed = False
+
+		if warm_up:
+			self.warm_up()
+
+	def warm_up(self):
+		'''Starts creating slow resources in a background thread, so that 
+		they are ready by the time they are needed'''
+
+		Thread(target=self._warm_up_resources, daemon=True).start()
+
+	def _warm_up_resources(self):
+		try:
+			self.gc
+			# We make sure in the GUI part that all necessary settings are made 
+			if 'GS' in self.config:
+				self.ws
+		except Exception as e:
+			logger.debug(f'Google Spreadsheet warm-up failed: {e}')
+		try:
+			self.cj
+		except Exception as e:
+			logger.debug(f'Browser cookies warm-up failed: {e}')
+		logger.debug('Backend warm-up finished')
+
+	def _lazy(self, name, factory):
+		'''Returns a resource, creating it on first use. If the resource 
+		is being created by another thread, waits for it to finish'''
+
+		with self._resource_locks[name]:
+			if name not in self._resources:
+				self._resources[name] = factory()
+			return self._resources[name]
+
+	def _set_resource(self, name, value):
+		with self._resource_locks[name]:
+			self._resources[name] = value
+
+	@property
+	def gc(self):
+		'''Authorized Google Sheets client'''
+		return self._lazy('gc', lambda: authorize(client_secret=self.path_to_client_secret))
+
+	@property
+	def gs(self):
+		'''Google Spreadsheet chosen in settings'''
+		return self._lazy('gs', lambda: self.gc.open_by_key(self.config['GS']['spreadsheet_id']))
+
+	@gs.setter
+	def gs(self, value):
+		self._set_resource('gs', value)
+
+	@property
+	def ws(self):
+		'''Worksheet with aggregated ad campaign data'''
+		return self._lazy('ws', lambda: self.gs.worksheet_by_title(self.config['GS']['sheet_name']))
+
+	@ws.setter
+	def ws(self, value):
+		self._set_resource('ws', value)
+
+	@property
+	def cj(self):
+		'''User's browser cookies'''
+		return self._lazy('cj', self._get_cookies)
 
 	def _get_cookies(self, ):
 		'''Returns user's browser cookies'''
@@ -56,6 +263,130 @@ class Backend:
 			cj = chrome()
 		return cj
 
+	def session(self, name):
+		'''Returns pooled keep-alive HTTP session of a platform. The session 
+		only carries browser cookies of the platform's domains'''
+
+		with self._sessions_lock:
+			if name in self._sessions:
+				return self._sessions[name]
+
+		# Built outside the lock: reading browser cookies is slow and must not 
+		# hold up sessions of other platforms
+		s = Session()
+		pool_size = self.pool_sizes.get(name, max(self.pf_workers.get(name, 1), 4))
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+		s.mount('https://', adapter)
+		s.mount('http://', adapter)
+
+		# Sessions without cookie domains never touch the browser, 
+		# so they work where there is no Chrome (headless server)
+		domains = self.SESSION_DOMAINS.get(name, ())
+		if domains:
+			for cookie in self.cj:
+				domain = cookie.domain.lstrip('.')
+				if any(domain == d or domain.endswith('.' + d) for d in domains):
+					s.cookies.set_cookie(cookie)
+
+		with self._sessions_lock:
+			# Another thread may have built the session meanwhile
+			return self._sessions.setdefault(name, s)
+
+	def _settled_till(self):
+		'''Returns the last day whose statistics platforms no longer change.
+		Days are settled 'settle_days' days after they end, the setting is 
+		shared by the response cache and VK day stats'''
+
+		cache_config = self.config.get('cache', {})
+		# Older configs had the setting in VK section
+		settle_days = cache_config.get('settle_days', 
+			self.config.get('Вконтакте', {}).get('settle_days', 3))
+		return date.today() - timedelta(days=settle_days)
+
+	def _cache_response(self, key, value, date_to=None):
+		'''Stores platform response in the response cache. Responses for date 
+		ranges closed on a settled day are stored permanently'''
+
+		closed = date_to is not None and date_to <= self._settled_till()
+		self.response_cache.set(key, value, permanent=closed)
+
+	def governor(self, name):
+		'''Returns request rate governor of a platform'''
+
+		with self._governors_lock:
+			if name not in self._governors:
+				self._governors[name] = RateGovernor(name, **self.rate_limits.get(name, {'rate': 5}))
+		return self._governors[name]
+
+	def _compile_templates(self):
+		'''Compiles static headers and params of platform requests once'''
+
+		templates = {}
+		for (pf, name), (method, url, volatile) in self.REQUEST_TEMPLATES.items():
+			request_config = self.config.get(pf, {}).get(name)
+			if request_config is None:
+				continue
+			templates[pf, name] = RequestTemplate.from_config(method, url, request_config, volatile)
+			# Per request values saved by previous versions are not kept
+			for part in ('headers', 'params'):
+				for key in volatile:
+					(request_config.get(part) or {}).pop(key, None)
+		return templates
+
+	def _send(self, pf, spec, session=None, **kwargs):
+		'''Sends a request built from a template'''
+
+		return self._request(pf, spec.method, spec.url, session=session, 
+			headers=dict(spec.headers), params=dict(spec.params), **kwargs)
+
+	def _request(self, pf, method, url, session=None, **kwargs):
+		'''Sends HTTP request with the platform's session through its rate 
+		governor. Throttled requests are retried'''
+
+		s = self.session(session or pf)
+		return self.governor(pf).call(
+			lambda: s.request(method, url, **kwargs),
+			check_result=lambda r: self._throttle_delay(pf, r)
+		)
+
+	def _throttle_delay(self, pf, r):
+		'''Returns None if the response is not a throttling error, otherwise
+		seconds to wait (0 if the platform did not tell)'''
+
+		retry_after = r.headers.get('Retry-After')
+		delay = float(retry_after) if retry_after and retry_after.isdigit() else 0
+		if r.status_code in (429, 503):
+			return delay
+
+		# VK and FB report throttling in json body
+		if pf in ('Вконтакте', 'Facebook'):
+			try:
+				body = r.json()
+			except ValueError:
+				return None
+			error = body.get('error') if isinstance(body, dict) else None
+			if not isinstance(error, dict):
+				return None
+			if pf == 'Вконтакте' and error.get('error_code') in self.VK_THROTTLE_CODES:
+				return delay
+			if pf == 'Facebook' and error.get('code') in self.FB_THROTTLE_CODES:
+				return delay
+
+		return None
+
+	def _sheets_call(self, func, *args, **kwargs):
+		'''Calls Google Sheets API method through its rate governor'''
+
+		def check_error(e):
+			resp = getattr(e, 'resp', None)
+			if getattr(resp, 'status', None) in (429, 503):
+				retry_after = resp.get('retry-after', '')
+				return float(retry_after) if retry_after.isdigit() else 0
+			return None
+
+		return self.governor('Google Sheets').call(
+			lambda: func(*args, **kwargs), check_error=check_error)
+
 	def get_gs_config(self):
 		if 'GS' in self.config:
 			return self.config['GS']
@@ -94,16 +425,146 @@ class Backend:
 	def get_pf_names(self):
 		return self.platforms
 
-	def get_cbr_usd_rate(self):
-		'''Downloads current official USD conversion rate from Russia's
-		Central Bank and returns a number with 4 floating points'''
+	def _merge(self, pf, data):
+		'''Adds platform data to the metrics store and passes it to the write
+		pipeline. Safe to call from several worker threads'''
+
+		keys = []
+		for campaign_id in data:
+			self.metrics.update(pf, campaign_id, data[campaign_id])
+			keys.append(MetricsStore.key(pf, campaign_id))
+		for key in keys:
+			self._emit('campaign_fetched', platform=pf, campaign_id=key[1], 
+				data=self.metrics.get(*key))
+		self._checkpoint('fetched', keys)
+		if self._normalizer is not None:
+			self._normalizer.put(keys)
+
+	def _checkpoint(self, status, keys):
+		'''Records status of (platform, campaign ID) campaigns in the run 
+		journal, fetched ones together with their data'''
+
+		entries = []
+		for pf, campaign_id in keys:
+			journal_key = self._journal_keys.get((pf, str(campaign_id)))
+			if journal_key is not None:
+				entries.append((journal_key, status, 
+					self.metrics.get(pf, campaign_id) if status == 'fetched' else None))
+		# One append and fsync per merged, normalized or written batch
+		self.journal.record_many(entries)
+
+	def _resume(self, input_dict):
+		'''Splits campaigns into the ones to fetch and the ones completed by 
+		the interrupted run: {pf: [campaign]} and {pf: {campaign_id: entry}}'''
+
+		state = self.journal.load()
+		pending, restored = {}, {}
+		for pf in input_dict:
+			for campaign in input_dict[pf]:
+				entry = state.get(RunJournal.campaign_key(pf, campaign))
+				if entry is None or entry['data'] is None:
+					pending.setdefault(pf, []).append(campaign)
+				else:
+					restored.setdefault(pf, {})[campaign['id']] = entry
+		logger.info(f'Resuming run: {sum(len(i) for i in restored.values())} campaigns '
+			f'restored from journal, {sum(len(i) for i in pending.values())} to fetch')
+		return pending, restored
+
+	def _restore(self, restored):
+		'''Passes campaigns restored from the journal on: written ones only go
+		to the user report, others are written again'''
+
+		for pf in restored:
+			written = {
+				i: e['data'] for i, e in restored[pf].items() if e['status'] == 'written'
+			}
+			for campaign_id in written:
+				self.metrics.update(pf, campaign_id, written[campaign_id])
+				self._emit('campaign_fetched', platform=pf, campaign_id=campaign_id, 
+					data=self.metrics.get(pf, campaign_id))
 
-		cbr = get('http://www.cbr.ru/scripts/XML_daily.asp')
-		soup = BeautifulSoup(cbr.content, 'xml')
-		rate = float(soup.find('CharCode', text='USD').find_next_sibling('Value')\
-			.string.replace(',','.'))
-		logger.info(f'Курс ЦБ USD на {self.today_date}: {rate}')
-		return rate
+			not_written = {
+				i: e['data'] for i, e in restored[pf].items() if e['status'] != 'written'
+			}
+			if not_written:
+				self._merge(pf, not_written)
+
+	def _emit(self, event, **info):
+		'''Reports run progress to the callback given to run, if any. 
+		May be called from worker threads'''
+
+		if self._progress:
+			self._progress(dict(info, event=event))
+
+	def _check_cancelled(self):
+		'''Stops the run if it was cancelled by the user'''
+
+		if self._cancel is not None and self._cancel.is_set():
+			raise RunCancelled()
+
+	def _pool_map(self, pf, func, items):
+		'''Applies func to every item using no more than the platform's worker 
+		limit threads. Results are returned in the order of items'''
+
+		def task(item):
+			self._check_cancelled()
+			return func(item)
+
+		items = list(items)
+		workers = min(self.pf_workers.get(pf, 1), len(items))
+		if not self.concurrent or workers <= 1:
+			return [task(i) for i in items]
+		with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=pf) as pool:
+			return list(pool.map(task, items))
+
+	def get_cbr_rates(self, currency, date_from, date_to):
+		'''Returns {date: rate} of Russia's Central Bank for every day of the 
+		period. Rates of past days are stored in config and never downloaded 
+		again, missing ones are downloaded in bulk with a single request'''
+
+		rates = self.config.setdefault('CBR', {}).setdefault('rates', {})\
+			.setdefault(currency, {})
+		days = date_range(date_from, date_to)
+		result = {d: rates[d.isoformat()] for d in days if d.isoformat() in rates}
+		missing = [d for d in days if d not in result]
+
+		if missing:
+			# CBR does not set rates on weekends and holidays, the last set rate
+			# is in force on those days, so the request starts a bit earlier
+			published = self._download_cbr_rates(
+				currency, missing[0] - timedelta(days=10), missing[-1])
+			published_days = sorted(published)
+
+			for d in missing:
+				idx = bisect_right(published_days, d)
+				if not idx:
+					logger.info(f'Курс ЦБ {currency} на {d} не найден')
+					continue
+				result[d] = published[published_days[idx - 1]]
+				# Today's and future rates may still be changed by CBR
+				if d < date.today():
+					rates[d.isoformat()] = result[d]
+
+		return result
+
+	def _download_cbr_rates(self, currency, date_from, date_to):
+		'''Downloads rates set by Russia's Central Bank for a period. Returns
+		{date: rate} only for days the rate was set on'''
+
+		logger.info(f'Загрузка курсов ЦБ {currency} с {date_from} по {date_to}')
+		cbr = self._request('CBR', 'get', 'http://www.cbr.ru/scripts/XML_dynamic.asp', params={
+			'date_req1': date_from.strftime("%d/%m/%Y"),
+			'date_req2': date_to.strftime("%d/%m/%Y"),
+			'VAL_NM_RQ': self.CBR_CURRENCY_IDS[currency]
+		})
+
+		published = {}
+		for record in ElementTree.fromstring(cbr.content).iter('Record'):
+			day, month, year = record.get('Date').split('.')
+			published[date(int(year), int(month), int(day))] = round(
+				float(record.find('Value').text.replace(',', '.')) / 
+				int(record.find('Nominal').text), 4)
+		return published
 
 	def process_vk(self, campaigns):
 		'''Collects AD statistics from VK using official API given user's input
@@ -111,7 +572,6 @@ class Backend:
 
 		logger.info("Отправка запроса в ВК")
 
-		url = 'https://api.vk.com/method/ads.getStatistics'
 		data = {}
 
 		'''
@@ -125,96 +585,204 @@ class Backend:
 		}
 		'''
 
-		for campaign in campaigns:
+		# Only days missing from the local cache or not settled yet are requested
+		fetch_periods = [self._vk_fetch_period(c) for c in campaigns]
+
+		# Responses to the same requests made before are taken from cache,
+		# campaigns with the same period are requested together in one call
+		stats = {}
+		groups = {}
+		for campaign, period in zip(campaigns, fetch_periods):
+			if period is None:
+				continue
+			cached = self.response_cache.get(self._vk_cache_key(campaign['id'], period))
+			if cached is not None:
+				stats[(period, campaign['id'])] = cached
+			else:
+				groups.setdefault(period, []).append(campaign)
+
+		calls = []
+		for (period, date_from, date_to), group in groups.items():
+			ids = [c['id'] for c in group]
+			for i in range(0, len(ids), self.VK_MAX_IDS):
+				calls.append({
+					'account_id': self.config['Вконтакте']['vk_ad_account_id'],
+					'ids_type': 'campaign',
+					'ids': ','.join(ids[i:i + self.VK_MAX_IDS]),
+					'period': period,
+					'date_from': date_from,
+					'date_to': date_to
+				})
+
+		# Calls with different periods are packed into 'execute' requests
+		batches = [
+			calls[i:i + self.VK_EXECUTE_LIMIT] 
+			for i in range(0, len(calls), self.VK_EXECUTE_LIMIT)
+		]
+		responses = self._pool_map('Вконтакте', self._vk_get_statistics, batches)
+
+		# Splitting combined responses back by period and campaign
+		failed = set()
+		for batch, batch_response in zip(batches, responses):
+			for call, call_response in zip(batch, batch_response):
+				period_key = (call['period'], call['date_from'], call['date_to'])
+				if not call_response:
+					logger.info(f"Ошибка запроса в ВК для ID {call['ids']}")
+					failed.update((period_key, i) for i in call['ids'].split(','))
+					continue
+				for item in call_response:
+					stats[(period_key, str(item['id']))] = item['stats']
+				for campaign_id in call['ids'].split(','):
+					self._cache_response(
+						self._vk_cache_key(campaign_id, period_key), 
+						stats.setdefault((period_key, campaign_id), []),
+						date.fromisoformat(call['date_to']) if call['period'] == 'day' else None
+					)
+
+		for campaign, period in zip(campaigns, fetch_periods):
+			if (period, campaign['id']) in failed:
+				continue
+			if campaign['period'] == 'Тек. месяц':
+				campaign_stats = stats.get((period, campaign['id']))
+			else:
+				campaign_stats = self._vk_days_stats(
+					campaign, period, stats.get((period, campaign['id']), []))
+			if not campaign_stats:
+				logger.info(f'VK data not found for ID {campaign["id"]}')
+				continue
+			data[campaign['id']] = self._parse_vk_stats(campaign, campaign_stats)
+			self._merge('Вконтакте', {campaign['id']: data[campaign['id']]})
+
+		logger.debug(f'VK DATA: {data}')
+
+	def _vk_period(self, campaign):
+		'''Returns (period, date_from, date_to) parameters of the VK request 
+		for a campaign'''
+
+		if campaign['period'] == 'Тек. месяц':
+			return 'month', 0, self.current_month
+		return (
+			'day', 
+			campaign['dates'][0].strftime("%Y-%m-%d"), 
+			campaign['dates'][1].strftime("%Y-%m-%d")
+		)
+
+	def _vk_fetch_period(self, campaign):
+		'''Returns VK request period of a campaign. For campaigns with dates 
+		only days absent from the day stats cache are requested, None 
+		means that all days are cached'''
+
+		if campaign['period'] == 'Тек. месяц':
+			return self._vk_period(campaign)
+
+		cached = self.config['Вконтакте'].get('day_stats', {}).get(campaign['id'], {})
+		needed = [d for d in date_range(*campaign['dates']) if d.isoformat() not in cached]
+		if not needed:
+			logger.debug(f'VK stats for ID {campaign["id"]} are taken from cache')
+			return None
+		return 'day', needed[0].isoformat(), needed[-1].isoformat()
+
+	def _vk_cache_key(self, campaign_id, period):
+		return ('Вконтакте', self.config['Вконтакте']['vk_ad_account_id'], 
+			campaign_id) + tuple(period)
+
+	def _vk_days_stats(self, campaign, period, fetched):
+		'''Stores fetched days of a campaign in the day stats cache and returns
+		its stats for every active day of the campaign dates. Days are cached 
+		once they are settled (see _settled_till)'''
+
+		cache = self.config['Вконтакте'].setdefault('day_stats', {})\
+			.setdefault(campaign['id'], {})
+		settled_till = self._settled_till()
+
+		# Days without activity are absent in VK response, they are cached 
+		# as empty so that they are not requested again
+		fresh = {}
+		if period is not None:
+			fetched_days = {i['day']: i for i in fetched}
+			for d in date_range(date.fromisoformat(period[1]), date.fromisoformat(period[2])):
+				day_stats = fetched_days.get(d.isoformat(), {})
+				if d <= settled_till:
+					cache[d.isoformat()] = day_stats
+				else:
+					fresh[d.isoformat()] = day_stats
 
-			request_data = {
+		days = [
+			cache.get(d.isoformat()) or fresh.get(d.isoformat()) 
+			for d in date_range(*campaign['dates'])
+		]
+		return [i for i in days if i]
 
-				'account_id': self.config['Вконтакте']['vk_ad_account_id'],
-				'ids_type': 'campaign',
-				'ids': campaign['id'],
-				'period': 'month' if campaign['period'] == 'Тек. месяц' else 'day',
-				'date_from': 0 if campaign['period'] == 'Тек. месяц' 
-								else campaign['dates'][0].strftime("%Y-%m-%d"),
-				'date_to': self.current_month if campaign['period'] == 'Тек. месяц' 
-								else campaign['dates'][1].strftime("%Y-%m-%d"),
-				'access_token': self.config['Вконтакте']['vk_access_token'],
-				'v': '5.124'
+	def _vk_call(self, method, request_data):
+		'''Calls VK API method and returns its json response'''
 
-			}
+		url = f'https://api.vk.com/method/{method}'
+		request_data = dict(request_data, 
+			access_token=self.config['Вконтакте']['vk_access_token'], v='5.124')
 
-			try:
-				r = get(url, params=request_data)
-				logger.debug('GET WORKED')
-			except:
-				r = post(url, data=request_data)
-				logger.debug('POST WORKED')
+		# 'execute' code and long id lists do not fit in a URL: the server 
+		# answers 414 with an html page, so they are always sent by POST
+		if method == 'execute' or len(urlencode(request_data)) > self.VK_MAX_GET_LENGTH:
+			r = self._request('Вконтакте', 'post', url, data=request_data)
+		else:
+			r = self._request('Вконтакте', 'get', url, params=request_data)
 
-			json_response = r.json()
+		return r.json()
 
-			if "error" in json_response or \
-			not len(json_response['response'][0]['stats']):
-				logger.info("Ошибка запроса в ВК")
-				logger.debug(json_response)
-				return
+	def _vk_get_statistics(self, calls):
+		'''Sends ads.getStatistics calls to VK: a single call directly, several
+		calls in one 'execute' round-trip. Returns a list with the 'response'
+		of every call or None if the call failed'''
 
-			logger.debug(f'VK API response: {json_response}')
+		if len(calls) == 1:
+			json_response = self._vk_call('ads.getStatistics', calls[0])
+		else:
+			code = 'return [' + ','.join(
+				f'API.ads.getStatistics({json.dumps(c, ensure_ascii=False)})' 
+				for c in calls
+			) + '];'
+			json_response = self._vk_call('execute', {'code': code})
 
-			# No campaigns on video views (at least for that client)
-			# Two cases are handled: if month we're just collecting info from 
-			# the response, if days it sums up indicators
+		logger.debug(f'VK API response: {json_response}')
 
-			NA_list = []
-			data[campaign['id']] = {}
+		if 'error' in json_response:
+			logger.debug(json_response)
+			return [None] * len(calls)
 
-			if campaign['period'] == 'Тек. месяц':
-				for key in ['spent', 'impressions', 'clicks', 'reach']:
-					if campaign[key]:
-						if key in json_response['response'][0]['stats'][0]:
-							data[campaign['id']][key] = json_response['response'][0]['stats'][0][key]
-						else:
-							NA_list.append(key)
-				data[campaign['id']]['spent'] = float(data[campaign['id']]['spent'])
-			else:
-				for key in ['spent', 'impressions', 'clicks', 'reach']:
-					if campaign[key]:
-						if key in json_response['response'][0]['stats'][0]:
-							data[campaign['id']][key] = json_response['response'][0]['stats'][0][key]
-						else:
-							NA_list.append(key)
-				data[campaign['id']]['spent'] = float(data[campaign['id']]['spent'])
-
-				for i in range(1, len(json_response['response'][0]['stats'])):
-					try:
-						for key in data[campaign['id']].keys():
-							if key == 'spent':
-								data[campaign['id']]['spent'] += \
-								float(json_response['response'][0]['stats'][i][key])
-							else:
-								data[campaign['id']][key] += json_response['response'][0]['stats'][i][key]
-					except:
-							continue
-
-				logger.info(f"Data returned from "
-					f"{json_response['response'][0]['stats'][0]['day']} to "
-					f"{json_response['response'][0]['stats'][-1]['day']}")
-
-			logger.info(f'For ID {campaign["id"]} VK data extracted: '
-				f'{data[campaign["id"]]}')
-			if NA_list: logger.info(f'VK data not found: {NA_list}')
-			logger.debug(f'VK DATA: {data}')
-		
-		self.data_to_write.update(data)
-		self.result_data.update({'Вконтакте': data})
+		if 'execute_errors' in json_response:
+			logger.debug(f"VK execute errors: {json_response['execute_errors']}")
+
+		if len(calls) == 1:
+			return [json_response['response']]
+		# Failed calls inside 'execute' are returned as false
+		return [i or None for i in json_response['response']]
+
+	def _parse_vk_stats(self, campaign, stats):
+		'''Extracts chosen indicators from campaign's VK stats list'''
+
+		# Two cases are handled: if month we're just collecting info from 
+		# the response, if days it sums up indicators
+		if campaign['period'] == 'Тек. месяц':
+			stats = stats[:1]
+		else:
+			logger.info(f"Data returned from {stats[0]['day']} to "
+				f"{stats[-1]['day']}")
+
+		chosen = [key for key in ['spent', 'impressions', 'clicks', 'reach', 'views'] 
+			if campaign.get(key)]
+		data, NA_list = aggregate(stats, chosen, names={'views': 'video_views'})
+
+		logger.info(f'For ID {campaign["id"]} VK data extracted: {data}')
+		if NA_list: logger.info(f'VK data not found: {NA_list}')
+
+		return data
 
 	def get_fb_creds(self):
 		'''Gets FB access token and session_id'''
 
 		logger.info("Request for FB access token and session id")
-		r_auth = get('https://business.facebook.com/adsmanager/\
-			manage/campaigns', 
-			headers=self.config['Facebook']['authorize']['headers'], 
-			params=self.config['Facebook']['authorize']['params'], 
-			cookies=self.cj)
+		r_auth = self._send('Facebook', self.templates['Facebook', 'authorize'].build(),
+			session='Facebook Ads Manager')
 
 		token_re = re.compile(r'window.__accessToken="(.*)";')
 		token_search_result = re.search(token_re, r_auth.text)
@@ -226,152 +794,332 @@ class Backend:
 
 		return access_token, session_id
 
+	def ensure_fb_creds(self, wait=True):
+		'''Makes sure FB access token and session id are cached and valid. 
+		Expired credentials are refreshed right away (or in the background if
+		wait is False), credentials close to expiry are refreshed in the 
+		background while the current ones are still used'''
+
+		creds = self.config['Facebook'].get('creds', {})
+		ttl = self.config['Facebook'].get('creds_ttl', 3600)
+		margin = self.config['Facebook'].get('creds_refresh_margin', 600)
+		age = time() - creds.get('obtained_at', 0)
+
+		if age >= ttl:
+			if self._fb_creds_failed:
+				# Ads Manager was already scraped in vain during this run
+				return False
+			logger.debug('FB credentials are missing or expired')
+			self._refresh_fb_creds_in_background()
+			if wait:
+				self._fb_creds_thread.join()
+		elif age >= ttl - margin:
+			logger.debug('FB credentials expire soon, refreshing in the background')
+			self._refresh_fb_creds_in_background()
+
+		return self.fb_creds_valid()
+
+	def fb_creds_valid(self):
+		'''Whether cached FB credentials exist and have not expired'''
+
+		creds = self.config['Facebook'].get('creds', {})
+		return bool(creds.get('access_token')) and \
+			time() - creds.get('obtained_at', 0) < self.config['Facebook'].get('creds_ttl', 3600)
+
+	def _refresh_fb_creds_in_background(self):
+		'''Starts FB credentials refresh unless one is already running'''
+
+		with self._fb_creds_lock:
+			if self._fb_creds_thread is None or not self._fb_creds_thread.is_alive():
+				self._fb_creds_thread = Thread(target=self.refresh_fb_creds, daemon=True)
+				self._fb_creds_thread.start()
+
+	def refresh_fb_creds(self):
+		'''Gets new FB credentials and caches them together with the time 
+		they were obtained'''
+
+		access_token, session_id = self.get_fb_creds()
+		if not all([access_token, session_id]):
+			logger.info("Did not manage to get FB credentials")
+			self._fb_creds_failed = True
+			return False
+		self._fb_creds_failed = False
+
+		self.config['Facebook']['creds'] = {
+			'access_token': access_token,
+			'session_id': session_id,
+			'obtained_at': time()
+		}
+		return True
+
+	def _fb_creds_params(self):
+		'''Request parameters with cached FB credentials'''
+
+		creds = self.config['Facebook'].get('creds', {})
+		return {
+			'access_token': creds.get('access_token'),
+			'_sessionID': creds.get('session_id')
+		}
+
 	def process_fb(self, campaigns):
 		'''Collects active FB ad campaign statistics using Graph API according
 		to clients' account IDs provided by user '''
 
 		logger.info("Отправка запроса в Facebook")
 
-		# Key translation dict
-		translate = {
-			'clicks': 'clicks',
-			'impressions': 'impressions',
-			'reach': 'reach',
-			'spend': 'spent'
-		}
-
-		data = {}
+		data, groups = self._fb_groups(campaigns)
+		if data:
+			self._merge('Facebook', data)
+		if not groups:
+			logger.debug(f'FB DATA (cached): {data}')
+			return
+
+		# Checking cached credentials up front instead of waiting for error 190,
+		# only when something has to be requested
+		if not self.ensure_fb_creds():
+			logger.info('Не удалось получить доступ к Facebook, кампании пропущены')
+			return
+
+		for account_data in self._pool_map('Facebook', self._fb_account_data, groups.items()):
+			data.update(account_data)
+		logger.debug(f'FB DATA: {data}')
 
-		rate = self.get_cbr_usd_rate()
+	def _fb_groups(self, campaigns):
+		'''Takes FB campaigns requested before from the response cache and
+		groups the rest by account and time range, they are requested 
+		together. Returns cached {campaign ID: data} and 
+		{(client_id, since, until): [campaign ID]}'''
 
+		cached, groups = {}, {}
 		for campaign in campaigns:
+			client_id, since, until = \
+				campaign['client_id'], str(campaign['dates'][0]), str(campaign['dates'][1])
+			campaign_data = self.response_cache.get(
+				('Facebook', client_id, campaign['id'], since, until))
+			if campaign_data is not None:
+				cached[campaign['id']] = campaign_data
+			else:
+				groups.setdefault((client_id, since, until), []).append(campaign['id'])
+		return cached, groups
+
+	def _fb_account_data(self, group):
+		'''Requests statistics of campaigns of one FB ad account and time range.
+		Returns {campaign ID: {indicator: value}}'''
 
-			# Modifying parameters and headers before the request
-			self.config['Facebook']['get_campaign_data']['params'].update({
+		(client_id, since, until), ids = group
 
-				'filtering': f'[{{"field":"campaign.delivery_info",'
-				f'"operator":"IN","value":["active","archived","completed",'
-				f'"inactive","limited","not_delivering","not_published",'
-				f'"pending_review","permanently_deleted","recently_completed",'
-				f'"recently_rejected","rejected","scheduled"]}},'
-				f'{{"field":"campaign.id","operator":"IN",'
-				f'"value":["{campaign["id"]}"]}}]',
+		j = self._fb_am_tabular(client_id, ids, since, until)
+		if j is None:
+			return {}
+
+		# Parsing response' json
+		'''
+		'data' model = {
+			campaign ID: {
+				indicator1: value,
+				indicator2: value,
+				...
+			},
+			...
+		}
+		'''
+		account_data = self._parse_fb_rows(j)
+
+		logger.info(f'For FB Client {client_id} the following data extracted: '
+			f'{account_data}')
+		for campaign_id in set(ids) - set(account_data):
+			logger.info(f'FB data not found for CAMPAIGN {campaign_id}')
+
+		# Spend converted at a wrong rate or dropped must not be cached
+		if self._convert_fb_spent(client_id, account_data, since, until):
+			for campaign_id, campaign_data in account_data.items():
+				self._cache_response(('Facebook', client_id, campaign_id, since, until), 
+					campaign_data, date.fromisoformat(until))
+		self._merge('Facebook', account_data)
+		return account_data
+
+	def _convert_fb_spent(self, client_id, account_data, since, until):
+		'''Converts FB spend of account's campaigns from USD to RUB using CBR 
+		rate of the day the money was spent. Returns False if the conversion
+		was not complete: a rate or daily spend could not be obtained'''
+
+		spent_ids = [i for i in account_data if 'spent' in account_data[i]]
+		if not spent_ids:
+			return True
+
+		date_from, date_to = date.fromisoformat(since), date.fromisoformat(until)
+		rates = self.get_cbr_rates('USD', date_from, date_to)
+		if not rates:
+			# Spend in USD must not be written as RUB
+			logger.info(f'Курс ЦБ USD за {since} - {until} не найден, '
+				f'расход FB клиента {client_id} не записан')
+			for campaign_id in spent_ids:
+				del account_data[campaign_id]['spent']
+			return False
+		last_rate = rates[max(rates)]
+		complete = len(rates) == len(date_range(date_from, date_to))
+
+		# Daily spend is only needed if the rate changed during the period
+		daily_spend = {}
+		if len(set(rates.values())) > 1:
+			daily_spend = self._fb_daily_spend(client_id, spent_ids, since, until)
+			if daily_spend is None:
+				logger.info(f'Расход FB клиента {client_id} по дням не получен, '
+					f'пересчитан по курсу на {max(rates)}')
+				daily_spend, complete = {}, False
+
+		for campaign_id in spent_ids:
+			indicators = account_data[campaign_id]
+			if campaign_id in daily_spend:
+				days = daily_spend[campaign_id]
+				indicators['spent'] = round(weighted_sum(
+					days.values(), [rates.get(d, last_rate) for d in days]), 2)
+			else:
+				indicators['spent'] = round(float(indicators['spent']) * last_rate, 2)
+		return complete
+
+	def _fb_daily_spend(self, client_id, ids, since, until):
+		'''Returns {campaign ID: {date: spend}} of FB campaigns using Insights API
+		with daily breakdown. None is returned on error'''
+
+		spec = self.templates['Facebook', 'get_campaign_data'].build(
+			url='https://graph.facebook.com/v7.0/act_{client_id}/insights', 
+			client_id=client_id
+		)
+		url = spec.url
+		params = {
+			'level': 'campaign',
+			'time_increment': 1,
+			'fields': 'campaign_id,spend',
+			'filtering': json.dumps([{'field': 'campaign.id', 'operator': 'IN', 'value': ids}]),
+			'time_range': json.dumps({'since': since, 'until': until}),
+			'limit': 500,
+			'access_token': self._fb_creds_params()['access_token']
+		}
 
-				'time_range': f'{{"since":"{campaign["dates"][0]}",'
-				f'"until":"{campaign["dates"][1]}"}}'
+		daily_spend = {}
+		while url:
+			j = self._request('Facebook', 'get', url, headers=dict(spec.headers),
+				params=params).json()
+			if 'error' in j:
+				logger.debug(f'FB Insights error for CLIENT {client_id}: {j}')
+				return None
+			for row in j.get('data', []):
+				daily_spend.setdefault(row['campaign_id'], {})[
+					date.fromisoformat(row['date_start'])] = float(row.get('spend', 0))
+			# Next page url already contains all the parameters
+			url, params = j.get('paging', {}).get('next'), None
+
+		return daily_spend
+
+	def _fb_am_tabular(self, client_id, ids, since, until):
+		'''Requests statistics of several campaigns of one FB ad account in 
+		a single am_tabular call. Returns response json or None if FB 
+		credentials could not be obtained'''
+
+		campaign_ids = ','.join(f'"{i}"' for i in ids)
+		campaign_params = {
+
+			'filtering': f'[{{"field":"campaign.delivery_info",'
+			f'"operator":"IN","value":["active","archived","completed",'
+			f'"inactive","limited","not_delivering","not_published",'
+			f'"pending_review","permanently_deleted","recently_completed",'
+			f'"recently_rejected","rejected","scheduled"]}},'
+			f'{{"field":"campaign.id","operator":"IN",'
+			f'"value":[{campaign_ids}]}}]',
+
+			'time_range': f'{{"since":"{since}","until":"{until}"}}'
 
-			})
+		}
 
-			r = get(f'https://graph.facebook.com/v7.0/'
-				f'act_{campaign["client_id"]}/am_tabular',
-				headers=self.config['Facebook']['get_campaign_data']['headers'],
-				params=self.config['Facebook']['get_campaign_data']['params'])
+		creds_params = self._fb_creds_params()
+		r = self._send('Facebook', self.templates['Facebook', 'get_campaign_data'].build(
+			dict(campaign_params, **creds_params), client_id=client_id))
+		j = r.json()
+
+		logger.debug(f'FB Graph response for CLIENT {client_id} '
+			f'CAMPAIGNS {ids}: {j}')
+
+		if 'error' in j and j['error']['code'] == 190:
+			# Token was revoked before its expiry time. Other accounts' 
+			# threads may hit it too, credentials are refreshed only once
+			with self._fb_creds_lock:
+				if self._fb_creds_params() == creds_params:
+					self.config['Facebook'].pop('creds', None)
+			if not self.ensure_fb_creds():
+				return None
+
+			r = self._send('Facebook', self.templates['Facebook', 'get_campaign_data'].build(
+				dict(campaign_params, **self._fb_creds_params()), client_id=client_id))
 			j = r.json()
 
-			logger.debug(f'FB Graph response for CLIENT '
-				f'{campaign["client_id"]} CAMPAIGN {campaign["id"]}: {j}')
+		elif 'error' in j:
+			
+			logger.debug("Unknown error in FB server response")
 
-			if 'error' in j and j['error']['code'] == 190:
-				access_token, session_id = self.get_fb_creds()
-				if all([access_token, session_id]):
-					
-					self.config['Facebook']['get_campaign_data']['params'].update({
-						'access_token': access_token,
-						'_sessionID': session_id
-					})
+		return j
 
-					r = get(f'https://graph.facebook.com/v7.0/'
-						f'act_{campaign["client_id"]}/am_tabular',
-						headers=self.config['Facebook']['get_campaign_data']['headers'],
-						params=self.config['Facebook']['get_campaign_data']['params'])
-					j = r.json()
+	def _parse_fb_rows(self, j):
+		'''Extracts indicators of every campaign row of am_tabular response'''
 
-				else:
-					
-					logger.info("Did not manage to get FB credentials")
-					logger.debug(f'FB DATA: {data}')
-		
-					self.data_to_write.update(data)
-					self.result_data.update({'Facebook': data})
-					return 
-
-			elif 'error' in j:
-				
-				logger.debug("Unknown error in FB server response")
-
-			# Parsing response' json
-			'''
-			'data' model = {
-				campaign ID: {
-					indicator1: value,
-					indicator2: value,
-					...
-				},
-				...
-			}
-			'''
+		# Key translation dict
+		translate = {
+			'clicks': 'clicks',
+			'impressions': 'impressions',
+			'reach': 'reach',
+			'spend': 'spent'
+		}
+
+		data = {}
+
+		try:
+			table = j['data'][0]
+		except Exception as e:
+			logger.debug(f'Error occured while trying to parse this data: \n{e}')
+			return data
+
+		for row in table.get('rows', []):
 			try:
-				data[j['data'][0]['rows'][0]['dimension_values'][0]] = {}
-				for i in range(len(j['data'][0]['headers']['atomic_columns'])):
-					data[
-						j['data'][0]['rows'][0]['dimension_values'][0]
-					][
+				campaign_id = row['dimension_values'][0]
+				data[campaign_id] = {}
+				for i in range(len(table['headers']['atomic_columns'])):
+					data[campaign_id][
 						translate[ # Using program indicator names instead of FB native
-							j['data'][0]['headers']['atomic_columns'][i]['name']
+							table['headers']['atomic_columns'][i]['name']
 						]
-					] = j['data'][0]['rows'][0]['atomic_values'][i]
+					] = row['atomic_values'][i]
 
-				if j['data'][0]['rows'][0]['dimension_values'][3] == 'LINK_CLICKS':
-					data[j['data'][0]['rows'][0]['dimension_values'][0]]['clicks'] = j['data'][0]['rows'][0]['result_values'][0]['value']
+				if row['dimension_values'][3] == 'LINK_CLICKS':
+					data[campaign_id]['clicks'] = row['result_values'][0]['value']
 
-				elif j['data'][0]['rows'][0]['dimension_values'][3] == 'CONVERSIONS':
-					data[j['data'][0]['rows'][0]['dimension_values'][0]]['result'] = j['data'][0]['rows'][0]['result_values'][0]['value']
+				elif row['dimension_values'][3] == 'CONVERSIONS':
+					data[campaign_id]['result'] = row['result_values'][0]['value']
 
 				else:
-					logger.debug(f"Unknown FB result target: {j['data'][0]['rows'][0]['dimension_values'][3]}")
+					logger.debug(f"Unknown FB result target: {row['dimension_values'][3]}")
 
 			except Exception as e:
 				logger.debug(f'Error occured while trying to parse this data: \n{e}')
 
-			logger.info(f'For FB Client {campaign["client_id"]} CAMPAIGN '
-				f'{campaign["id"]} the following data extracted: '
-				f'{data[j["data"][0]["rows"][0]["dimension_values"][0]]}')
-
-		for i in data:
-			data[i]['spent'] = round(float(data[i]['spent']) * rate, 2)
-			
-		logger.debug(f'FB DATA: {data}')
-		
-		self.data_to_write.update(data)
-		self.result_data.update({'Facebook': data})
+		return data
 
 	def process_mt(self, campaigns):
 		'''Collects active MyTarget ad campaign statistics using json API according
 		to clients' account IDs provided by user'''
 
-		# Getting internal MT client ids
-		client_internal_ids = {}
-
-		for c in campaigns:
-			if c['client_id'] not in client_internal_ids:
-
-				self.config['MyTarget']['get_client_id']['params']['sudo'] = c['client_id']
-
-				r = get(
-					'https://target.my.com/dashboard', 
-					headers=self.config['MyTarget']['get_client_id']['headers'],
-					params=self.config['MyTarget']['get_client_id']['params'], 
-					cookies=self.cj
-				)
-
-				logger.debug(f'Got client id html: {[i for i in r.iter_lines()][2]}')
-
-				soup = BeautifulSoup(r.text, features='lxml')
-				client_int_id = soup.html['data-ga-userid']
+		# Getting internal MT client ids, the mapping never changes so it is
+		# stored in config and only unknown clients are resolved
+		client_internal_ids = self.config['MyTarget'].setdefault('client_internal_ids', {})
 
-				logger.debug(f"Got client id {client_int_id} for input ID {c['client_id']}")
+		unknown_clients = list(dict.fromkeys(
+			c['client_id'] for c in campaigns if c['client_id'] not in client_internal_ids
+		))
+		resolved = self._pool_map('MyTarget', self._get_mt_internal_id, unknown_clients)
+		for client_id, client_int_id in zip(unknown_clients, resolved):
+			if client_int_id:
+				client_internal_ids[client_id] = client_int_id
 
-				client_internal_ids[c['client_id']] = client_int_id
+		campaigns = [c for c in campaigns if c['client_id'] in client_internal_ids]
 
 		# Getting data for each campaign
 		data = {}
@@ -386,120 +1134,462 @@ class Backend:
 		}
 		'''
 
-		for c in campaigns:
+		for campaign_data in self._pool_map('MyTarget', 
+				lambda c: self._mt_campaign_data(c, client_internal_ids[c['client_id']]), campaigns):
+			data.update(campaign_data)
 
-			# Getting ad data
+		logger.info(f'MT DATA: {data}')
 
-			self.config['MyTarget']['get_ad_data']['headers'].update(
-				{
-					'X-Target-Sudo':  c['client_id'],
-					'Referer': f"https://target.my.com/dashboard?sudo="
-					f"{c['client_id']}"
-				}
-			)
-			self.config['MyTarget']['get_ad_data']['params'].update(
-				{
-					'id': c['id'],
-					'date_from': c['dates'][0].strftime("%d.%m.%Y"),
-					'date_to': c['dates'][1].strftime("%d.%m.%Y"),
-					'adv_user': client_internal_ids[c['client_id']],
-					'_': str(int(time() * 1000))
-				}
-			)
-			r = get(
-				'https://target.my.com/api/v3/statistics/campaigns/day.json', 
-				headers=self.config['MyTarget']['get_ad_data']['headers'], 
-				params=self.config['MyTarget']['get_ad_data']['params'], 
-				cookies=self.cj
-			)
-			j = r.json()
+	def _mt_campaign_data(self, c, client_int_id):
+		'''Returns {campaign ID: {indicator: value}} of one MyTarget campaign, 
+		empty dict on error'''
+
+		cache_key = ('MyTarget', c['client_id'], c['id'], 
+			c['dates'][0].isoformat(), c['dates'][1].isoformat())
+		campaign_data = self.response_cache.get(cache_key)
+		if campaign_data is not None:
+			self._merge('MyTarget', campaign_data)
+			return campaign_data
+
+		# Getting ad data
+		spec = self.templates['MyTarget', 'get_ad_data'].build(
+			params={
+				'id': c['id'],
+				'date_from': c['dates'][0].strftime("%d.%m.%Y"),
+				'date_to': c['dates'][1].strftime("%d.%m.%Y"),
+				'adv_user': client_int_id,
+				'_': str(int(time() * 1000))
+			},
+			headers={
+				'X-Target-Sudo':  c['client_id'],
+				'Referer': f"https://target.my.com/dashboard?sudo="
+				f"{c['client_id']}"
+			}
+		)
+		j = self._send('MyTarget', spec).json()
 
-			logger.debug(f'Got ad data json: {j}')
-			if 'error' in j:
-				logger.debug(f"MyTarget returned an error: {j['error']['code']}")
-				# TO DO inform user about a problem
-			else:
-				for i in j['items']:
-					data[i['id']] = {}
-					data[i['id']]['impressions'] = i['total']['base']['shows']
-					data[i['id']]['clicks'] = i['total']['base']['clicks']
-					data[i['id']]['spent'] = i['total']['base']['spent']
-					data[i['id']]['reach'] = i['total']['uniques']['increment']
+		logger.debug(f'Got ad data json: {j}')
+		if 'error' in j:
+			logger.debug(f"MyTarget returned an error: {j['error']['code']}")
+			# TO DO inform user about a problem
+			return {}
 
-		logger.info(f'MT DATA: {data}')
-		
-		self.data_to_write.update(data)
-		self.result_data.update({'MyTarget': data})
+		campaign_data = {}
+		for i in j['items']:
+			campaign_data[i['id']] = {}
+			campaign_data[i['id']]['impressions'] = i['total']['base']['shows']
+			campaign_data[i['id']]['clicks'] = i['total']['base']['clicks']
+			campaign_data[i['id']]['spent'] = i['total']['base']['spent']
+			campaign_data[i['id']]['reach'] = i['total']['uniques']['increment']
+		self._cache_response(cache_key, campaign_data, c['dates'][1])
+		self._merge('MyTarget', campaign_data)
+		return campaign_data
+
+	def _get_mt_internal_id(self, client_id):
+		'''Returns internal MyTarget id of a client. The dashboard page is 
+		streamed and parsing stops as soon as the root tag is read'''
+
+		r = self._send('MyTarget', 
+			self.templates['MyTarget', 'get_client_id'].build({'sudo': client_id}), 
+			stream=True
+		)
+		r.encoding = r.encoding or 'utf-8'
+
+		parser = _RootTagParser()
+		try:
+			for chunk in r.iter_content(chunk_size=1024, decode_unicode=True):
+				parser.feed(chunk)
+				if parser.root_attrs is not None:
+					break
+		finally:
+			r.close()
+
+		client_int_id = (parser.root_attrs or {}).get('data-ga-userid')
+		if client_int_id:
+			logger.debug(f"Got client id {client_int_id} for input ID {client_id}")
+		else:
+			logger.info(f'Не удалось получить внутренний ID клиента MyTarget {client_id}')
 
-	def write_to_gspread(self):
-		'''Writes collected data to a specified Google Spreadsheet'''
+		return client_int_id
 
-		if 'campaign_rows' not in self.config['GS']:
-			self.config['GS']['campaign_rows'] = {}
+	def get_campaign_rows(self, keys=None):
+		'''Returns {campaign ID: row number} index of the sheet built from a
+		single read of the campaign ID column, the header row is skipped.
+		keys are (platform, campaign ID) used to find the column, see 
+		_get_id_column'''
 
-		# Storing campaign rows in GS to save traffic in the future
-		for campaign_id in self.data_to_write:
-			if campaign_id not in self.config['GS']['campaign_rows']:
-				try:
-					cells_list = self.ws.find(campaign_id)
-				except Exception as e:
-					logger.debug(f"During campaign id search the following error happened: \n{e}")
-				if not cells_list:
-					logger.debug(f"{campaign_id} not found in GS")
-				else:
-					self.config['GS']['campaign_rows'][campaign_id] = cells_list[0].row
-		
-		# Deleting no longer actual entries from config
-		for campaign_id in set(self.config['GS']['campaign_rows']) - set(self.data_to_write):
-			self.config['GS']['campaign_rows'].pop(campaign_id)
-
-		# Updating values
-		all_values = self.ws.get_all_values()
-		for campaign_id in self.data_to_write:
-			for indicator in self.data_to_write[campaign_id]:
-				all_values[
-						self.config['GS']['campaign_rows'][campaign_id]-1
-					][
-						self.config['GS']['columns'][indicator]['column_number']-1
-					] = self.data_to_write[campaign_id][indicator]
+		id_column = self._get_id_column(keys)
+		if not id_column:
+			return {}
+
+		values = self._sheets_call(self.ws.get_col, id_column, include_tailing_empty=False)
+		campaign_rows = {}
+		for row, value in enumerate(values[1:], 2):
+			value = str(value).strip()
+			if value and value not in campaign_rows:
+				campaign_rows[value] = row
+		return campaign_rows
+
+	def _get_id_column(self, keys=None):
+		'''Returns the number of the column with campaign IDs. Configs saved 
+		before the column was chosen in settings find it once by one of the
+		collected campaign IDs (keys, all collected campaigns by default)'''
+
+		if 'id' in self.config['GS']['columns']:
+			return self.config['GS']['columns']['id']['column_number']
+
+		for pf, campaign_id in (self.metrics.keys if keys is None else keys):
+			try:
+				cells_list = self._sheets_call(self.ws.find, str(campaign_id))
+			except Exception as e:
+				logger.debug(f"During campaign id search the following error happened: \n{e}")
+				continue
+			if cells_list:
+				self.config['GS']['columns']['id'] = {
+					'name': self._sheets_call(self.ws.get_value, (1, cells_list[0].col)),
+					'column_number': cells_list[0].col
+				}
+				return cells_list[0].col
+
+		logger.info('Столбец с ID кампаний не найден в Google таблице')
+		return None
+
+	def write_to_gspread(self, dry_run=False):
+		'''Writes collected data to a specified Google Spreadsheet. Only cells
+		whose values differ from the sheet are sent. In dry run nothing is
+		written, the changes are just logged. Returns the number of updated
+		campaign rows, the changes are kept in self.last_diff'''
+
+		cells, row_campaigns = self._campaign_cells(
+			self.metrics.keys, self.get_campaign_rows()
+		)
+		self.last_diff = []
+		return len(self._write_cells(cells, row_campaigns, dry_run))
+
+	def _campaign_cells(self, keys, campaign_rows):
+		'''Normalizes collected data of (platform, campaign ID) campaigns to 
+		sheet cells: {row: {column: value}} and {row: (platform, campaign ID)}'''
+
+		cells = {}
+		row_campaigns = {}
+		for pf, campaign_id in keys:
+			row = campaign_rows.get(campaign_id)
+			if not row:
+				logger.info(f'ID {campaign_id} не найден в Google таблице')
+				continue
+
+			# Campaigns of different platforms may have the same ID, the row
+			# belongs to the first one normalized during the run
+			owner = self._row_owners.setdefault(row, (pf, campaign_id))
+			if owner != (pf, campaign_id):
+				logger.warning(f'ID {campaign_id} ({pf}) совпадает с ID кампании {owner[0]}, '
+					f'строка {row} уже занята, данные не записаны')
+				continue
+
+			row_campaigns[row] = (pf, campaign_id)
+			row_cells = cells.setdefault(row, {})
+			indicators = self.metrics.get(pf, campaign_id)
+			for indicator in indicators:
+				# Not every collected indicator has a column in the sheet (views)
+				if indicator not in self.config['GS']['columns']:
+					continue
+				row_cells[
+					self.config['GS']['columns'][indicator]['column_number']
+				] = indicators[indicator]
 
 			# Updating date values
-			all_values[
-					self.config['GS']['campaign_rows'][campaign_id]-1
-				][
-					self.config['GS']['columns']['date']['column_number']-1
-				] = self.today_date
+			row_cells[
+				self.config['GS']['columns']['date']['column_number']
+			] = self.today_date
+
+		self._checkpoint('normalized', row_campaigns.values())
+		return cells, row_campaigns
+
+	def _write_cells(self, cells, row_campaigns, dry_run=False):
+		'''Writes the cells which differ from the sheet, adds the changes to
+		self.last_diff. Returns the set of changed rows'''
+
+		diff = self.diff_cells(cells, row_campaigns)
+		self.last_diff.extend(diff)
+		for change in diff:
+			logger.info(f"{'[Dry run] ' if dry_run else ''}ID {change['campaign_id']}, "
+				f"{change['column']}: {change['old']!r} -> {change['new']!r}")
+
+		changed = {}
+		for change in diff:
+			changed.setdefault(change['row'], {})[change['column_number']] = change['new']
+		if dry_run:
+			return set(changed)
+
+		ranges, values, _ = self._cells_to_ranges(changed)
+		logger.debug(f'Updating GS ranges: {ranges}')
+		if ranges:
+			self._sheets_call(self.ws.update_values_batch, ranges, values, parse=True)
+		self._checkpoint('written', row_campaigns.values())
+		return set(changed)
+
+	def diff_cells(self, cells, row_campaigns):
+		'''Reads current unformatted values of the cells in one batch and returns a list
+		of changes: platform, campaign, row, column, old and new value. Cells which 
+		already have the new value are skipped'''
+
+		ranges, _, origins = self._cells_to_ranges(cells)
+		if not ranges:
+			return []
+		# Numbers are read as they are, not formatted with the sheet's locale,
+		# dates are read as text like the date written by the app
+		current = self._sheets_call(self.ws.get_values_batch, ranges, 
+			value_render=ValueRenderOption.UNFORMATTED_VALUE,
+			date_time_render_option=DateTimeRenderOption.FORMATTED_STRING)
+
+		column_names = {
+			i['column_number']: i['name'] for i in self.config['GS']['columns'].values()
+		}
+		old_values = {}
+		for (first_row, first_column), block in zip(origins, current):
+			for i, row_values in enumerate(block or []):
+				for j, value in enumerate(row_values):
+					old_values[(first_row + i, first_column + j)] = value
+
+		changes = []
+		for row in sorted(cells):
+			for column in sorted(cells[row]):
+				old = old_values.get((row, column), '')
+				new = cells[row][column]
+				if not self._same_value(old, new):
+					pf, campaign_id = row_campaigns.get(row, (None, None))
+					changes.append({
+						'platform': pf,
+						'campaign_id': campaign_id,
+						'row': row,
+						'column': column_names.get(column, column),
+						'column_number': column,
+						'old': old,
+						'new': new
+					})
+		return changes
 
-		self.ws.update_values(crange=(1,1), values=all_values, parse=True)
+	def _same_value(self, old, new):
+		'''Compares an unformatted sheet value with a value to write: numbers
+		by value, anything else as text'''
+
+		if isinstance(old, (int, float)) and not isinstance(old, bool):
+			try:
+				return abs(old - float(new)) < 0.005
+			except (TypeError, ValueError):
+				return False
+		return str(old).strip() == str(new).strip()
+
+	def _cells_to_ranges(self, cells):
+		'''Groups {row: {column: value}} cells into as few rectangular A1 ranges 
+		as possible. Returns lists of ranges, their values and their top left
+		(row, column) cells'''
+
+		# Contiguous columns of a row make a block, blocks with the same 
+		# columns in consecutive rows are merged together
+		blocks = []
+		open_blocks = {}
+		for row in sorted(cells):
+			row_blocks = {}
+			for column in sorted(cells[row]):
+				if row_blocks and column == last_column + 1:
+					row_blocks[first_column].append(cells[row][column])
+				else:
+					first_column = column
+					row_blocks[first_column] = [cells[row][column]]
+				last_column = column
+
+			for first_column, row_values in row_blocks.items():
+				key = (first_column, len(row_values))
+				block = open_blocks.get(key)
+				if block and block['last_row'] == row - 1:
+					block['last_row'] = row
+					block['values'].append(row_values)
+				else:
+					block = {'first_row': row, 'last_row': row, 'values': [row_values]}
+					open_blocks[key] = block
+					blocks.append((key, block))
+
+		ranges, values, origins = [], [], []
+		for (first_column, width), block in blocks:
+			ranges.append(
+				f"{format_addr((block['first_row'], first_column))}:"
+				f"{format_addr((block['last_row'], first_column + width - 1))}"
+			)
+			values.append(block['values'])
+			origins.append((block['first_row'], first_column))
+		return ranges, values, origins
 
 	def load_config(self):
-		'''Loads configuration parameters'''
+		'''Loads configuration parameters from the state store. The YAML 
+		config is migrated to the store on first launch'''
 		logger.info('Call to load backend config')
-		if path.exists(self.path_to_config):
-			with open(self.path_to_config, 'r', encoding='utf-8') as y:
-				conf = yaml.safe_load(y)
-			logger.info(f'Config loaded')
-			return conf
-		logger.info('Returning empty config')
-		return {}
+		self.store.migrate_yaml(self.path_to_config, 'config')
+
+		conf = self.store.items('config')
+		# What is in the store now, to save only changed keys
+		self._stored = {('config', key): pickle.dumps(value) for key, value in conf.items()}
+		for namespace, (section, key) in self.STORE_NAMESPACES.items():
+			values = self.store.items(namespace)
+			self._stored.update({(namespace, i): pickle.dumps(values[i]) for i in values})
+			if values:
+				conf.setdefault(section, {})[key] = values
+
+		# Campaign rows index was kept by earlier versions, the sheet 
+		# is read on every run anyway, so it is not stored any more
+		self.store.clear('campaign_rows')
+		for key in ('campaign_rows', 'campaign_rows_fingerprint'):
+			conf.get('GS', {}).pop(key, None)
+		logger.info(f'Config loaded')
+		return conf
 
 	def save_config(self):
-		'''Saves backend parameters to disk'''
-
-		logger.info('Call to save config file')
-		with open(self.path_to_config, 'w', encoding='utf-8') as f:
-			yaml.dump(self.config, f, allow_unicode=True)
-		logger.info('Input saved to disk')
+		'''Saves changed backend parameters to the state store'''
+
+		logger.info('Call to save config')
+		entries = {i: pickle.dumps(value) for i, value in self._config_entries().items()}
+		changed = {i: pickle.loads(entries[i]) for i in entries if entries[i] != self._stored.get(i)}
+		deleted = [i for i in self._stored if i not in entries]
+		if changed or deleted:
+			self.store.write(changed, deleted)
+		self._stored = entries
+		logger.info(f'{len(changed)} config keys saved, {len(deleted)} deleted')
+
+	def _config_entries(self):
+		'''Splits the config into {(namespace, key): value} entries of the 
+		state store'''
+
+		entries = {}
+		for section, value in self.config.items():
+			if isinstance(value, dict):
+				value = dict(value)
+				for namespace, (split_section, key) in self.STORE_NAMESPACES.items():
+					if split_section == section and key in value:
+						entries.update({
+							(namespace, str(i)): v for i, v in value.pop(key).items()
+						})
+			entries[('config', section)] = value
+		return entries
 
 	def get_result(self):
-		return self.result_data
+		return self.metrics
 
-	def run(self, input_dict):
+	def run(self, input_dict, progress=None, cancel=None, dry_run=False, resume=False):
 		'''Runs main backend process: parses ad platfoms and writes them
-		to Google Spreadsheet'''
-
-		for pf in input_dict:
-			self.pf_task[pf](input_dict[pf])
-		logger.info(f"Data to write to GS: {self.data_to_write}")
-		self.write_to_gspread()
+		to Google Spreadsheet. Returns the number of updated campaign rows.
+
+		progress is called with event dicts ('platform_started', 
+		'campaign_fetched', 'platform_finished', 'batch_written', 
+		'sheet_written') and may be called from worker threads. Setting 
+		cancel (threading.Event) stops the run with RunCancelled, batches 
+		written before that stay in the sheet. In dry run the sheet is not 
+		changed, changes that would be written are kept in self.last_diff.
+		With resume campaigns completed by the previous (interrupted) run 
+		today are taken from the run journal instead of being fetched again'''
+
+		self._progress = progress
+		self._cancel = cancel
+		self.metrics = MetricsStore()
+		self.last_diff = []
+		self._row_owners = {}
+
+		# Dry run changes nothing, so it's not journaled
+		self._journal_keys = {} if dry_run else {
+			(pf, str(c['id'])): RunJournal.campaign_key(pf, c)
+			for pf in input_dict for c in input_dict[pf]
+		}
+		restored = {}
+		if resume:
+			input_dict, restored = self._resume(input_dict)
+		elif not dry_run:
+			self.journal.start()
+
+		self._fb_creds_failed = False
+		if 'Facebook' in input_dict and self._fb_groups(input_dict['Facebook'])[1]:
+			# Refreshing FB credentials while other platforms are processed,
+			# unless every FB campaign is in the response cache
+			self.ensure_fb_creds(wait=False)
+
+		if self.concurrent:
+			written = self._run_pipeline(input_dict, restored, dry_run)
+		else:
+			self._restore(restored)
+			for pf in input_dict:
+				self._process_platform(pf, input_dict[pf])
+			self._check_cancelled()
+			written = self.write_to_gspread(dry_run=dry_run)
+		logger.info(f'Data of {len(self.metrics)} campaigns collected')
+
+		self._emit('sheet_written', rows=written)
 		self.save_config()
+		self.response_cache.evict()
+		return written
+
+	def _run_pipeline(self, input_dict, restored, dry_run):
+		'''Fetches platforms concurrently and writes their results as soon as
+		they are ready: fetchers -> normalization -> batching writer, stages 
+		are connected by bounded queues (see pipeline.py). The first cells 
+		are written after the fastest platform, not after the slowest one.
+		Returns the number of updated campaign rows'''
+
+		pipeline_config = self.config.get('run', {}).get('pipeline', {})
+		queue_size = pipeline_config.get('queue_size', 100)
+		written_rows = set()
+
+		def flush(cells, row_campaigns):
+			self._check_cancelled()
+			rows = self._write_cells(cells, row_campaigns, dry_run)
+			written_rows.update(rows)
+			self._emit('batch_written', rows=len(rows))
+
+		writer = BatchWriter(
+			'GS writer', flush, 
+			batch_size=pipeline_config.get('batch_size', 20),
+			flush_interval=pipeline_config.get('flush_interval', 2.0),
+			maxsize=queue_size
+		).start()
+
+		errors = []
+		with ThreadPoolExecutor(max_workers=len(input_dict) + 1) as pool:
+			# Campaign rows are read while platforms are fetched. Configs
+			# without the ID column setting find the column by fetched IDs,
+			# so they read the rows when the first campaigns are normalized
+			prefetched = None
+			if 'id' in self.config['GS']['columns']:
+				prefetched = pool.submit(self.get_campaign_rows)
+			campaign_rows = {}
+
+			def normalize(keys):
+				if not campaign_rows:
+					campaign_rows.update(
+						prefetched.result() if prefetched else self.get_campaign_rows(keys))
+				writer.put(self._campaign_cells(keys, campaign_rows))
+
+			self._normalizer = Stage('Normalizer', normalize, queue_size).start()
+			self._restore(restored)
+			futures = [
+				pool.submit(self._process_platform, pf, input_dict[pf]) for pf in input_dict
+			]
+			for f in futures:
+				try:
+					f.result()
+				except Exception as e:
+					errors.append(e)
+
+		# Results of the platforms that succeeded are written anyway
+		normalizer, self._normalizer = self._normalizer, None
+		for stage in (normalizer, writer):
+			try:
+				stage.close()
+			except Exception as e:
+				errors.append(e)
+		# Reraising the first platform error, same as the sequential mode does
+		if errors:
+			raise errors[0]
+		return len(written_rows)
+
+	def _process_platform(self, pf, campaigns):
+		self._check_cancelled()
+		self._emit('platform_started', platform=pf, campaigns=len(campaigns))
+		self.pf_task[pf](campaigns)
+		self._emit('platform_finished', platform=pf)
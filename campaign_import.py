@@ -0,0 +1,192 @@
+'''Parsing of campaigns pasted from a spreadsheet or loaded from CSV/TSV file.
+
+Columns (a header row is optional):
+
+	[client id,] campaign id, indicators, start date, end date
+
+Indicators are separated by spaces, commas or semicolons and named either 
+as in the app (spent, impressions, clicks, reach, views) or as in the 
+campaign table (Потрачено, Показы, Клики, Охват, Просмотры). Empty 
+indicators mean all of them except views. Empty dates mean the current 
+month, dates are accepted as dd.mm.yyyy, yyyy-mm-dd or dd/mm/yyyy.
+With a header row columns may go in any order and every indicator may 
+have its own column marked with 1/0, да/нет, yes/no, true/false, +/-.'''
+
+import csv
+from calendar import monthrange
+from collections import namedtuple
+from datetime import date, datetime
+
+
+ImportResult = namedtuple('ImportResult', ['campaigns', 'errors', 'duplicates'])
+
+INDICATORS = {
+	'spent': 'Потрачено',
+	'impressions': 'Показы',
+	'clicks': 'Клики',
+	'reach': 'Охват',
+	'views': 'Просмотры'
+}
+DEFAULT_INDICATORS = ['spent', 'impressions', 'clicks', 'reach']
+
+# Header names of the columns in lower case
+HEADERS = {
+	'client_id': {'client_id', 'client id', 'id клиента', 'клиент'},
+	'id': {'id', 'campaign_id', 'campaign id', 'id кампании', 'кампания'},
+	'indicators': {'indicators', 'показатели'},
+	'date_from': {'date_from', 'start', 'начало'},
+	'date_to': {'date_to', 'end', 'конец'}
+}
+HEADERS.update({
+	key: {key, name.lower()} for key, name in INDICATORS.items()
+})
+
+DATE_FORMATS = ['%d.%m.%Y', '%Y-%m-%d', '%d/%m/%Y']
+TRUE_VALUES = {'1', 'да', 'yes', 'true', '+', 'x', 'v'}
+
+
+def parse_campaigns(text, has_client_id, existing=()):
+	'''Parses, validates and deduplicates campaigns in one pass. existing 
+	are (client_id, id) pairs of campaigns already added to the platform.
+	Returns ImportResult with campaign states ready for PlatformFrame, 
+	error messages and the number of skipped duplicates'''
+
+	lines = [line for line in text.splitlines() if line.strip()]
+	if not lines:
+		return ImportResult([], [], 0)
+
+	# A pasted spreadsheet range is always tab separated, while commas may
+	# separate indicators inside a cell, so tabs are never sniffed
+	if any('\t' in line for line in lines[:5]):
+		dialect = csv.excel_tab
+	else:
+		try:
+			dialect = csv.Sniffer().sniff('\n'.join(lines[:5]), delimiters=';,')
+		except csv.Error:
+			dialect = csv.excel
+	rows = csv.reader(lines, dialect)
+
+	first_row = next(rows)
+	columns = _header_columns(first_row)
+	if columns is None:
+		columns = _positional_columns(has_client_id)
+		rows = _chain([first_row], rows)
+		line_number = 0
+	else:
+		line_number = 1
+
+	seen = set(existing)
+	campaigns, errors, duplicates = [], [], 0
+
+	for row in rows:
+		line_number += 1
+		values = {
+			key: row[idx].strip() if idx < len(row) else '' 
+			for key, idx in columns.items()
+		}
+		try:
+			campaign = _make_campaign(values, has_client_id)
+		except ValueError as e:
+			errors.append(f'Строка {line_number}: {e}')
+			continue
+
+		key = (campaign['client_id'], campaign['id'])
+		if key in seen:
+			duplicates += 1
+			continue
+		seen.add(key)
+		campaigns.append(campaign)
+
+	return ImportResult(campaigns, errors, duplicates)
+
+
+def _chain(head, tail):
+	yield from head
+	yield from tail
+
+
+def _header_columns(row):
+	'''Returns {field: column index} if the row is a header, otherwise None'''
+
+	columns = {}
+	for idx, name in enumerate(row):
+		for key, names in HEADERS.items():
+			if name.strip().lower() in names:
+				columns[key] = idx
+	return columns if 'id' in columns else None
+
+
+def _positional_columns(has_client_id):
+	keys = ['id', 'indicators', 'date_from', 'date_to']
+	if has_client_id:
+		keys.insert(0, 'client_id')
+	return {key: idx for idx, key in enumerate(keys)}
+
+
+def _make_campaign(values, has_client_id):
+	'''Builds campaign state from the row values or raises ValueError'''
+
+	campaign_id = values.get('id', '')
+	if not campaign_id.isdigit():
+		raise ValueError(f'неверный ID кампании "{campaign_id}"')
+
+	client_id = values.get('client_id', '') if has_client_id else None
+	if has_client_id and not client_id:
+		raise ValueError('не указан ID клиента')
+
+	# Indicators given either by separate columns or by a list
+	if any(key in values for key in INDICATORS):
+		chosen = {key for key in INDICATORS if values.get(key, '').lower() in TRUE_VALUES}
+	else:
+		chosen = set()
+		for name in values.get('indicators', '').replace(',', ' ').replace(';', ' ').split():
+			key = _indicator_key(name)
+			if key is None:
+				raise ValueError(f'неизвестный показатель "{name}"')
+			chosen.add(key)
+		chosen = chosen or set(DEFAULT_INDICATORS)
+
+	date_from = _parse_date(values.get('date_from', ''))
+	date_to = _parse_date(values.get('date_to', ''))
+	if date_from is None and date_to is None:
+		period = 'Тек. месяц'
+		today = date.today()
+		dates = [
+			today.replace(day=1), 
+			today.replace(day=monthrange(today.year, today.month)[1])
+		]
+	elif date_from is None or date_to is None:
+		raise ValueError('указана только одна дата')
+	elif date_from > date_to:
+		raise ValueError('дата начала позже даты конца')
+	else:
+		period = 'Даты'
+		dates = [date_from, date_to]
+
+	campaign = {
+		'client_id': client_id,
+		'id': campaign_id,
+		'period': period,
+		'dates': dates
+	}
+	campaign.update({key: key in chosen for key in INDICATORS})
+	return campaign
+
+
+def _indicator_key(name):
+	name = name.strip().lower()
+	for key, label in INDICATORS.items():
+		if name in (key, label.lower()):
+			return key
+	return None
+
+
+def _parse_date(value):
+	if not value:
+		return None
+	for date_format in DATE_FORMATS:
+		try:
+			return datetime.strptime(value, date_format).date()
+		except ValueError:
+			continue
+	raise ValueError(f'неверная дата "{value}"')
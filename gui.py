@@ -1,46 +1,42 @@
 # -*- coding: utf-8 -*-
 
-import yaml
-from backend import Backend
+from backend import Backend, RunCancelled
+from campaign_import import parse_campaigns
 from calendar import monthrange
-from collections import OrderedDict
 from datetime import date
 from loguru import logger
-from os import path
+from queue import Empty, Queue
+from threading import Event, Thread
 from tkcalendar import DateEntry
-from tkinter import Tk, Frame, Toplevel, Menu, BooleanVar, StringVar, Label, Button, Entry, Checkbutton, OptionMenu
+from tkinter import END, Tk, Frame, Toplevel, Menu, BooleanVar, StringVar, Label, Button, Entry, Checkbutton, OptionMenu, Scrollbar, Text, TclError
+from tkinter.filedialog import askopenfilename
+from tkinter.ttk import Progressbar, Treeview
 
 
 class Row:
 	"""
-	Controls widgets relating to a campaign
+	Controls widgets of a campaign table line. Widgets are reused: a Row is
+	loaded with the state of whichever campaign is currently displayed in it
 	"""
 
-	def __init__(self, parent, row_number, has_client_id, init_state=None):
+	def __init__(self, parent, row_number, has_client_id, on_delete):
 
 		# Main variables
 		self.period = ['Тек. месяц', 'Даты']
+		self.parent = parent
+		self.row_number = row_number
+		self.locked = False
+		self.dates = self.month_dates()
 		
-		self.spent_var = BooleanVar(
-			value=(init_state['spent'] if init_state else False)
-			)
-		self.impressions_var = BooleanVar(
-			value=(init_state['impressions'] if init_state else False)
-			)
-		self.clicks_var = BooleanVar(
-			value=(init_state['clicks'] if init_state else False)
-			)
-		self.reach_var = BooleanVar(
-			value=(init_state['reach'] if init_state else False)
-			)
-		self.views_var = BooleanVar(
-			value=(init_state['views'] if init_state else False)
-			)
-		self.period_var = StringVar(
-			value=(init_state['period'] if init_state else self.period[0])
-			)
+		self.spent_var = BooleanVar(value=False)
+		self.impressions_var = BooleanVar(value=False)
+		self.clicks_var = BooleanVar(value=False)
+		self.reach_var = BooleanVar(value=False)
+		self.views_var = BooleanVar(value=False)
+		self.period_var = StringVar(value=self.period[0])
 		
-		# Widgets
+		# Widgets. Dates are shown as labels, date pickers are only created 
+		# when dates become editable
 		self.widgets = {
 			1: Entry(parent, width=50),
 			2: Checkbutton(parent, variable=self.spent_var),
@@ -50,34 +46,64 @@ class Row:
 			6: Checkbutton(parent, variable=self.views_var),
 			7: OptionMenu(parent, self.period_var, *self.period, 
 				command=lambda value: self.dates_block_edit(value)),
-			8: DateEntry(parent, date_pattern="dd.mm.y", locale='ru_RU', 
-				day=1),
-			9: DateEntry(parent, date_pattern="dd.mm.y", locale='ru_RU', 
-				day=self.ldom())
+			8: Label(parent),
+			9: Label(parent),
+			10: Button(parent, text='Удалить', command=on_delete)
 		}
+		self.date_entries = None
+		self.dates_editable = False
 
 		if has_client_id:
 			self.widgets.update({0: Entry(parent, width=50)})
 
-		# Initializing Entry and DateEntry fields
-		if init_state:
-			self.widgets[1].insert(0, init_state['id'])
+	def load(self, state, locked):
+		'''
+		Displays campaign state, locked campaigns can not be edited
+		'''
+		self.locked = locked
+		self.dates = list(state['dates'])
 
-			self.widgets[8].set_date(init_state['dates'][0])
-			self.widgets[9].set_date(init_state['dates'][1])
+		for i in [0, 1]:
+			if i in self.widgets:
+				self.widgets[i].config(state='normal')
+				self.widgets[i].delete(0, END)
+				self.widgets[i].insert(0, state['client_id' if i == 0 else 'id'] or '')
 
-			if has_client_id:
-				self.widgets[0].insert(0, init_state['client_id'])
-				self.widgets[0].config(state='disabled')
+		self.spent_var.set(state['spent'])
+		self.impressions_var.set(state['impressions'])
+		self.clicks_var.set(state['clicks'])
+		self.reach_var.set(state['reach'])
+		self.views_var.set(state['views'])
+		self.period_var.set(state['period'])
 
-			# Disabling editing mode
-			for i in range(1, 8):
-				self.widgets[i].config(state='disabled')
+		# Disabling editing mode
+		for i in range(0 if 0 in self.widgets else 1, 8):
+			self.widgets[i].config(state='disabled' if locked else 'normal')
 
-		self.widgets[8].config(state='disabled')
-		self.widgets[9].config(state='disabled')
+		self.show_dates(editable=not locked and state['period'] == self.period[1])
 
-		self.grid(row_number)
+	def show_dates(self, editable):
+		'''
+		Shows dates either as date pickers or as plain labels
+		'''
+		self.dates_editable = editable
+		if editable:
+			if self.date_entries is None:
+				self.date_entries = [
+					DateEntry(self.parent, date_pattern="dd.mm.y", locale='ru_RU')
+					for _ in range(2)
+				]
+			for i, date_entry in enumerate(self.date_entries):
+				date_entry.set_date(self.dates[i])
+				self.widgets[8 + i].grid_forget()
+				date_entry.grid(row=self.row_number, column=8 + i, sticky='nsew', pady=2)
+		else:
+			if self.date_entries is not None:
+				for date_entry in self.date_entries:
+					date_entry.grid_forget()
+			for i in range(2):
+				self.widgets[8 + i].config(text=self.dates[i].strftime("%d.%m.%Y"))
+				self.widgets[8 + i].grid(row=self.row_number, column=8 + i, sticky='nsew', pady=2)
 
 	def dates_block_edit(self, value):
 		'''
@@ -85,16 +111,11 @@ class Row:
 		'''
 		logger.info(f"Call to block dates editing with {value}")
 
-		self.widgets[8].config(state='normal')
-		self.widgets[9].config(state='normal')
-
 		if value == self.period[0]:
-
-			self.widgets[8].set_date(date.today().replace(day = 1))
-			self.widgets[9].set_date(date.today().replace(day = self.ldom()))
-
-			self.widgets[8].config(state='disabled')
-			self.widgets[9].config(state='disabled')
+			self.dates = self.month_dates()
+			self.show_dates(editable=False)
+		else:
+			self.show_dates(editable=True)
 
 	def del_placeholder(self, event):
 		'''
@@ -119,24 +140,31 @@ class Row:
 			'views': self.views_var.get(),
 			'period': self.period_var.get(),
 			'dates': [
-				self.widgets[8].get_date(),
-				self.widgets[9].get_date()
-			]
+				self.date_entries[0].get_date(),
+				self.date_entries[1].get_date()
+			] if self.dates_editable else list(self.dates)
 		}	
 
-	def grid(self, row):
+	def grid(self, row=None):
 		'''Places a Row class object to the particular row in the parent grid'''
 
+		if row is not None:
+			self.row_number = row
 		for i in self.widgets:
+			if i in (8, 9):
+				continue
 			if i == 0:
-				self.widgets[i].grid(row=row, column=i, sticky='nsew', padx=6, pady=2)
+				self.widgets[i].grid(row=self.row_number, column=i, sticky='nsew', padx=6, pady=2)
 			else:
-				self.widgets[i].grid(row=row, column=i, sticky='nsew', pady=2)
+				self.widgets[i].grid(row=self.row_number, column=i, sticky='nsew', pady=2)
 
 	def forget(self):
 		'''Removes Row widgets from GUI'''
 		for i in self.widgets:
 			self.widgets[i].grid_forget()
+		if self.date_entries is not None:
+			for date_entry in self.date_entries:
+				date_entry.grid_forget()
 
 	def start_column(self):
 		'''Returns starting column index'''
@@ -150,6 +178,10 @@ class Row:
 		'''Returns the last day of the current month'''
 		return monthrange(date.today().year, date.today().month)[1]
 
+	def month_dates(self):
+		'''Returns the first and the last days of the current month'''
+		return [date.today().replace(day=1), date.today().replace(day=self.ldom())]
+
 
 class ColumnRow:
 	'''Displays column names depending on the platform'''
@@ -223,6 +255,7 @@ class GSpreadWin(Toplevel):
 		self.sheets_dd_var = StringVar(value=self.gs_config.get('sheet_name', ''))
 
 		# column confirm widgets
+		self.id_lbl_col = Label(self, text="ID кампании")
 		self.date_lbl = Label(self, text="Дата")
 		self.fb_result_lbl = Label(self, text="Конверсии в FB")
 		self.spent_lbl = Label(self, text="Потрачено")
@@ -231,6 +264,7 @@ class GSpreadWin(Toplevel):
 		self.reach_lbl = Label(self, text="Охват")
 		# self.views_lbl = Label(self, text="Просмотры")
 
+		self.id_dd_var = StringVar(value=self.gs_config.get('columns', {}).get('id', {'name': ''})['name'])
 		self.date_dd_var = StringVar(value=self.gs_config.get('columns', {'date': {'name': ''}})['date']['name'])
 		self.fb_result_dd_var = StringVar(value=self.gs_config.get('columns', {'result': {'name': ''}})['result']['name'])
 		self.spent_dd_var = StringVar(value=self.gs_config.get('columns', {'spent': {'name': ''}})['spent']['name'])
@@ -262,6 +296,7 @@ class GSpreadWin(Toplevel):
 
 					self.columns_lbl = Label(self, text="Названия столбцов для каждого показателя:")
 
+					self.id_dd = OptionMenu(self, self.id_dd_var, self.id_dd_var.get())
 					self.date_dd = OptionMenu(self, self.date_dd_var, self.gs_config['columns']['date']['name'])
 					self.fb_result_dd = OptionMenu(self, self.fb_result_dd_var, self.gs_config['columns']['result']['name'])
 					self.spent_dd = OptionMenu(self, self.spent_dd_var, self.gs_config['columns']['spent']['name'])
@@ -362,6 +397,7 @@ class GSpreadWin(Toplevel):
 
 		self.columns_lbl = Label(self, text="Отметьте названия столбцов для каждого показателя:")
 
+		self.id_dd = OptionMenu(self, self.id_dd_var, *column_list)
 		self.date_dd = OptionMenu(self, self.date_dd_var, *column_list)
 		self.fb_result_dd = OptionMenu(self, self.fb_result_dd_var, *column_list)
 		self.spent_dd = OptionMenu(self, self.spent_dd_var, *column_list)
@@ -380,21 +416,23 @@ class GSpreadWin(Toplevel):
 
 		self.columns_lbl.grid(sticky="W", row=5, column=0, pady=2)
 		
-		self.date_lbl.grid(sticky="W", row=6, column=0)
-		self.fb_result_lbl.grid(sticky="W", row=7, column=0)
-		self.spent_lbl.grid(sticky="W", row=8, column=0)
-		self.impressions_lbl.grid(sticky="W", row=9, column=0)
-		self.clicks_lbl.grid(sticky="W", row=10, column=0)
-		self.reach_lbl.grid(sticky="W", row=11, column=0)
-		# self.views_lbl.grid(sticky="W", row=12, column=0)
-
-		self.date_dd.grid(sticky="W", row=6, column=1)
-		self.fb_result_dd.grid(sticky="W", row=7, column=1)
-		self.spent_dd.grid(sticky="W", row=8, column=1)
-		self.impressions_dd.grid(sticky="W", row=9, column=1)
-		self.clicks_dd.grid(sticky="W", row=10, column=1)
-		self.reach_dd.grid(sticky="W", row=11, column=1)
-		# self.views_dd.grid(sticky="W", row=12, column=1)
+		self.id_lbl_col.grid(sticky="W", row=6, column=0)
+		self.date_lbl.grid(sticky="W", row=7, column=0)
+		self.fb_result_lbl.grid(sticky="W", row=8, column=0)
+		self.spent_lbl.grid(sticky="W", row=9, column=0)
+		self.impressions_lbl.grid(sticky="W", row=10, column=0)
+		self.clicks_lbl.grid(sticky="W", row=11, column=0)
+		self.reach_lbl.grid(sticky="W", row=12, column=0)
+		# self.views_lbl.grid(sticky="W", row=13, column=0)
+
+		self.id_dd.grid(sticky="W", row=6, column=1)
+		self.date_dd.grid(sticky="W", row=7, column=1)
+		self.fb_result_dd.grid(sticky="W", row=8, column=1)
+		self.spent_dd.grid(sticky="W", row=9, column=1)
+		self.impressions_dd.grid(sticky="W", row=10, column=1)
+		self.clicks_dd.grid(sticky="W", row=11, column=1)
+		self.reach_dd.grid(sticky="W", row=12, column=1)
+		# self.views_dd.grid(sticky="W", row=13, column=1)
 
 	def confirm_gs_settings(self):
 		'''Action binded to settings confirm button: makes sure that all options 
@@ -403,6 +441,7 @@ class GSpreadWin(Toplevel):
 		self.columns_warning_lbl = Label(self, text="Не все столбцы выбраны")
 		self.columns_warning_lbl.grid_forget()
 		column_choice = {
+			'id': self.id_dd_var.get(),
 			'date': self.date_dd_var.get(),
 			'result': self.fb_result_dd_var.get(),
 			'spent': self.spent_dd_var.get(),
@@ -416,10 +455,61 @@ class GSpreadWin(Toplevel):
 		else:
 			logger.debug(f'column_choice: {column_choice}')
 			self.backend.send_column_choice(column_choice)
-			Label(self, text="Настройки сохранены").grid(row=12, column=0)
+			Label(self, text="Настройки сохранены").grid(row=13, column=0)
 			self.confirm_settings_btn.grid_forget()
 
 
+class ImportWindow(Toplevel):
+	'''Bulk import of campaigns pasted from a spreadsheet or loaded from a file'''
+
+	def __init__(self, platform_frame, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.config(padx=10, pady=10)
+		self.title(f"Импорт кампаний {platform_frame.name}")
+		self.platform_frame = platform_frame
+
+		columns = "ID клиента, ID кампании" if platform_frame.has_client_id else "ID кампании"
+		Label(self, justify='left', text=f"Вставьте диапазон из таблицы или загрузите CSV файл.\n"
+			f"Столбцы: {columns}, показатели, начало, конец.\n"
+			f"Без дат - текущий месяц, без показателей - все, кроме просмотров."
+		).grid(row=0, column=0, columnspan=4, sticky='W', pady=2)
+
+		self.text = Text(self, width=100, height=20)
+		self.text.grid(row=1, column=0, columnspan=4, sticky='nsew', pady=2)
+
+		Button(self, text="Из буфера обмена", command=self.paste).grid(row=2, column=0, pady=2)
+		Button(self, text="Из файла", command=self.load_file).grid(row=2, column=1, pady=2)
+		Button(self, text="Импортировать", command=self.import_campaigns).grid(row=2, column=2, pady=2)
+		Button(self, text="Закрыть", command=self.destroy).grid(row=2, column=3, pady=2)
+
+		self.result_lbl = Label(self, justify='left')
+		self.result_lbl.grid(row=3, column=0, columnspan=4, sticky='W', pady=2)
+
+	def paste(self):
+		try:
+			self.text.insert(END, self.clipboard_get())
+		except TclError:
+			self.result_lbl.config(text="Буфер обмена пуст")
+
+	def load_file(self):
+		file_name = askopenfilename(parent=self, 
+			filetypes=[("CSV/TSV", "*.csv *.tsv *.txt"), ("Все файлы", "*")])
+		if file_name:
+			with open(file_name, 'r', encoding='utf-8-sig') as f:
+				self.text.delete('1.0', END)
+				self.text.insert('1.0', f.read())
+
+	def import_campaigns(self):
+		result = self.platform_frame.import_campaigns(self.text.get('1.0', END))
+		report = f"Добавлено: {len(result.campaigns)}, дубликатов: {result.duplicates}, " \
+			f"ошибок: {len(result.errors)}"
+		if result.errors:
+			report += '\n' + '\n'.join(result.errors[:10])
+		self.result_lbl.config(text=report)
+		if result.campaigns:
+			self.text.delete('1.0', END)
+
+
 class Limitations(Toplevel):
 	'''Contains necessary info about current program limitations and assumptions'''
 
@@ -427,7 +517,6 @@ class Limitations(Toplevel):
 		super().__init__(*args, **kwargs)
 		self.config(padx=10, pady=10)
 		self.title("Ограничения программы")
-		Label(self, text="- После первого запуска с данной кампанией нельзя менять ее ряд в Гугл таблице").pack()
 		Label(self, text="- Если столбцы меняются местами, нужно заново пройти процесс настройки Гугл таблицы").pack()
 		Label(self, text="- Если нет инета, прога не запустится").pack()
 		Label(self, text="- Программа предполагает, что названия столбцов находятся в первом ряду Гугл таблицы").pack()
@@ -435,58 +524,75 @@ class Limitations(Toplevel):
 
 
 class Results_window(Toplevel):
-	'''Shows result of ad parsing to the user'''
+	'''Shows result of ad parsing to the user. Campaign rows are added 
+	as soon as their data comes from the backend'''
 
-	def __init__(self, ad_data, *args, **kwargs):
+	def __init__(self, ad_data=None, *args, **kwargs):
 		super().__init__(*args, **kwargs)
 		self.config(padx=10, pady=10)
 		self.title("Результаты работы программы")
 
 		self.column_names = [
-				"ID кампании", "Конверсии", "Потрачено", "Показы", 
+				"Конверсии", "Потрачено", "Показы", 
 				"Клики", "Охват", 
 				# "Просмотры"
 			]
-		Label(
-			self, text="Данные, записанные в Google таблицу:"
-		).grid(row=0, column=0, columnspan=len(self.column_names))
-		for idx, name in enumerate(self.column_names):
-			Label(
-				self, text=name, padx=2, pady=2
-			).grid(
-				row=1, column=idx+1, padx=2, pady=2, sticky='nsew'
-			)
+		self.indicators = [
+			'result', 'spent', 'impressions', 'clicks', 'reach', 
+			# 'views'
+		]
+
+		self.status_lbl = Label(self, text="Идет сбор данных...")
+		self.status_lbl.grid(row=0, column=0, columnspan=2)
+
+		# Platforms are tree nodes, their campaigns are child rows
+		self.tree = Treeview(self, columns=self.indicators, height=20)
+		self.tree.heading('#0', text="ID кампании")
+		for indicator, name in zip(self.indicators, self.column_names):
+			self.tree.heading(indicator, text=name)
+			self.tree.column(indicator, width=100, anchor='e')
+		scrollbar = Scrollbar(self, orient='vertical', command=self.tree.yview)
+		self.tree.configure(yscrollcommand=scrollbar.set)
+		self.tree.grid(row=1, column=0, sticky='nsew')
+		scrollbar.grid(row=1, column=1, sticky='ns')
+		self.rowconfigure(1, weight=1)
+		self.columnconfigure(0, weight=1)
+
+		self.platform_nodes = {}
 
-		col_n = {
-			'result': 2,
-			'spent': 3,
-			'impressions': 4,
-			'clicks': 5,
-			'reach': 6,
-			# 'views': 7
-		}
+		self.ok_btn = Button(self, text="OK", width=20, command=self.destroy)
+		self.ok_btn.grid(row=2, column=0, columnspan=2, pady=2)
 
-		row_count = 2
-		for pf_name in ad_data:
-			if ad_data[pf_name]:
-				n = len(ad_data[pf_name])
-				Label(
-					self, text=pf_name
-				).grid(row=row_count, column=0, rowspan=n)
-				for camp_id in ad_data[pf_name]:
-					Label(self, text=camp_id).grid(row=row_count, column=1)
-					for indicator in ad_data[pf_name][camp_id]:
-						Label(
-							self, text=ad_data[pf_name][camp_id][indicator]
-						).grid(row=row_count, column=col_n[indicator])
-					row_count += 1
+		if ad_data is not None:
+			for (pf_name, camp_id), indicators in ad_data.items():
+				self.add_row(pf_name, camp_id, indicators)
+			self.finish()
 
-		self.ok_btn = Button(self, text="OK", width=20, command=self.destroy)
-		self.ok_btn.grid(row=row_count, column=0, columnspan=len(self.column_names), pady=2)
+	def add_row(self, pf_name, camp_id, indicators):
+		'''Adds or updates a campaign row of the platform'''
+
+		if pf_name not in self.platform_nodes:
+			self.platform_nodes[pf_name] = self.tree.insert(
+				'', 'end', text=pf_name, open=True)
+
+		iid = f'{pf_name}:{camp_id}'
+		values = [indicators.get(i, '') for i in self.indicators]
+		if self.tree.exists(iid):
+			self.tree.item(iid, values=values)
+		else:
+			self.tree.insert(self.platform_nodes[pf_name], 'end', 
+				iid=iid, text=camp_id, values=values)
+
+	def finish(self, text="Данные, записанные в Google таблицу:"):
+		self.status_lbl.config(text=text)
 
 
 class PlatformFrame(Frame):
-	'''Controls widgets relating to a particular Ad Platform'''
+	'''Controls widgets relating to a particular Ad Platform. Campaigns are
+	kept in a plain list, widgets only exist for the campaigns of the current
+	page, so the frame is built equally fast for any number of campaigns'''
+
+	PAGE_SIZE = 15
 
 	def __init__(self, *args, name, row, init_states=None, **kwargs):
 		super().__init__(*args, **kwargs)
@@ -498,6 +604,7 @@ class PlatformFrame(Frame):
 		self.has_client_id = True if name in ['Facebook', 'MyTarget'] else False
 
 		self.DEL_BTN_COL = 10
+		self.NAV_ROW = self.PAGE_SIZE + 1
 
 		# Frame with Platform Name
 		self.name_frame = Frame(self)
@@ -509,19 +616,24 @@ class PlatformFrame(Frame):
 		self.rows_frame = Frame(self)
 		ColumnRow(self.rows_frame, self.has_client_id)
 
-		self.campaigns = OrderedDict()
-
-		if init_states:
-			for i, init_state in enumerate(init_states):
-				self.campaigns[i+1] = Row(self.rows_frame, i+1, self.has_client_id, 
-											init_state=init_state)
-				Button(
-					
-					self.rows_frame, 
-					text='Удалить', 
-					command=lambda x=i+1: self.delete_row(x)
-				
-				).grid(row=i+1, column=self.DEL_BTN_COL)
+		# Campaign data model: saved campaigns are locked for editing
+		self.campaigns = [
+			{'state': init_state, 'locked': True} for init_state in (init_states or [])
+		]
+		# Row widgets for the current page, created on demand
+		self.slots = []
+		self.page = 0
+
+		# Navigation between pages and new campaign button
+		self.nav_frame = Frame(self.rows_frame)
+		self.prev_btn = Button(self.nav_frame, text='<', command=lambda: self.show_page(self.page - 1))
+		self.page_lbl = Label(self.nav_frame)
+		self.next_btn = Button(self.nav_frame, text='>', command=lambda: self.show_page(self.page + 1))
+		self.import_btn = Button(self.nav_frame, text='Импорт', command=lambda: ImportWindow(self))
+		self.import_btn.pack(side='left', padx=5)
+		self.prev_btn.pack(side='left')
+		self.page_lbl.pack(side='left', padx=5)
+		self.next_btn.pack(side='left')
 
 		Button(
 
@@ -531,70 +643,125 @@ class PlatformFrame(Frame):
 
 		).grid(
 				
-			row=1+len(self.campaigns), 
+			row=self.NAV_ROW, 
 			column=0, 
 			columnspan=self.DEL_BTN_COL, 
 			sticky="nsew", 
 			pady=2
 			
 		)
+		self.nav_frame.grid(row=self.NAV_ROW, column=self.DEL_BTN_COL, sticky="e", pady=2)
+
+		self.show_page(0)
 
 		self.rows_frame.grid(row=0, column=1, sticky="nsew")
 		# Gridding Frames immedeately on initialization
 		self.grid(row=row, column=0, sticky="nsew", pady=2, padx=2)
 
+	def pages_count(self):
+		return max(1, -(-len(self.campaigns) // self.PAGE_SIZE))
+
+	def sync(self):
+		'''
+		Saves values entered into widgets of the current page to the model
+		'''
+		for slot_idx, campaign_idx in enumerate(self.visible_range()):
+			if not self.campaigns[campaign_idx]['locked']:
+				self.campaigns[campaign_idx]['state'] = self.slots[slot_idx].get()
+
+	def visible_range(self):
+		start = self.page * self.PAGE_SIZE
+		return range(start, min(start + self.PAGE_SIZE, len(self.campaigns)))
+
+	def show_page(self, page, sync=True):
+		'''
+		Loads campaigns of the page into Row widgets
+		'''
+		if sync:
+			self.sync()
+		self.page = min(max(page, 0), self.pages_count() - 1)
+
+		visible = self.visible_range()
+		while len(self.slots) < len(visible):
+			slot_idx = len(self.slots)
+			self.slots.append(Row(self.rows_frame, slot_idx + 1, self.has_client_id, 
+				on_delete=lambda x=slot_idx: self.delete_row(x)))
+
+		for slot_idx, slot in enumerate(self.slots):
+			if slot_idx < len(visible):
+				campaign = self.campaigns[visible[slot_idx]]
+				slot.grid()
+				slot.load(campaign['state'], campaign['locked'])
+			else:
+				slot.forget()
+
+		self.page_lbl.config(text=f'{self.page + 1} / {self.pages_count()}')
+		self.prev_btn.config(state='normal' if self.page > 0 else 'disabled')
+		self.next_btn.config(state='normal' if self.page < self.pages_count() - 1 else 'disabled')
+
+	def new_state(self):
+		'''Returns state of a newly added campaign'''
+		return {
+			'client_id': '' if self.has_client_id else None,
+			'id': '',
+			'spent': False,
+			'impressions': False,
+			'clicks': False,
+			'reach': False,
+			'views': False,
+			'period': 'Тек. месяц',
+			'dates': [date.today().replace(day=1), 
+				date.today().replace(day=monthrange(date.today().year, date.today().month)[1])]
+		}
+
 	def append_row(self):
 		'''
-		Creates data container and widgets for newly added campaign row
+		Creates data container for newly added campaign and shows it 
+		on the last page
 		'''
 		logger.info(f"Appending row to {self.name}")
 
-		last_key = next(reversed(self.campaigns)) if self.campaigns else 0
-		columns, rows = self.rows_frame.grid_size()
-		if rows-1 == last_key+1:
-			self.rows_frame.grid_slaves(row=last_key+1, column=0)[0].grid_forget()
-		self.campaigns[last_key+1] = Row(self.rows_frame, last_key+1, self.has_client_id)
-		Button(
-					
-			self.rows_frame, 
-			text='Удалить', 
-			command=lambda x=last_key+1: self.delete_row(x)
-		
-		).grid(row=last_key+1, column=self.DEL_BTN_COL)
-
-		if rows-1 == last_key+1:
-			Button(
-
-				self.rows_frame, 
-				text=f'Добавить кампанию {self.name}', 
-				command=self.append_row
-
-			).grid(
-					
-				row=last_key+2, 
-				column=0, 
-				columnspan=self.DEL_BTN_COL, 
-				sticky="nsew", 
-				pady=2
-				
+		self.sync()
+		self.campaigns.append({'state': self.new_state(), 'locked': False})
+		self.show_page(self.pages_count() - 1, sync=False)
+
+	def import_campaigns(self, text):
+		'''
+		Parses campaigns from CSV/TSV text and adds valid new ones to the 
+		model in one batch. Returns ImportResult
+		'''
+		self.sync()
+		result = parse_campaigns(text, self.has_client_id, existing=[
+			(i['state']['client_id'], i['state']['id']) for i in self.campaigns
+		])
+		logger.info(f"Importing {len(result.campaigns)} campaigns to {self.name}, "
+			f"{result.duplicates} duplicates, {len(result.errors)} errors")
+
+		if result.campaigns:
+			first_page = len(self.campaigns) // self.PAGE_SIZE
+			self.campaigns.extend(
+				{'state': campaign, 'locked': False} for campaign in result.campaigns
 			)
+			self.show_page(first_page, sync=False)
+		return result
 
-	def delete_row(self, row):
+	def delete_row(self, slot_idx):
 		'''
-		Deletes data container and widgets for unnecessary campaign row
+		Deletes data container of the campaign displayed in the row
 		'''
-		logger.info(f"Deleting {row} row in {self.name} block")
+		logger.info(f"Deleting {slot_idx + 1} row in {self.name} block")
 
-		self.campaigns[row].forget()
-		self.rows_frame.grid_slaves(row=row, column=self.DEL_BTN_COL)[0].grid_forget()
-		self.campaigns.pop(row)
+		self.sync()
+		self.campaigns.pop(self.visible_range()[slot_idx])
+		self.show_page(self.page, sync=False)
 
 	def get(self):
 		'''
 		Collects data from all Platforms rows
 		'''
+		self.sync()
 		return {
-			self.name: [self.campaigns[i].get() for i in self.campaigns]
+			self.name: [dict(i['state']) for i in self.campaigns]
 		}
 
 
@@ -730,24 +897,26 @@ class Program(Tk):
 		logger.info(f'Input {self.input_data} saved to internal dict')
 
 	def save_config(self):
-		'''Saves campaign parsing parameters to disk'''
-
-		logger.info('Call to save config file')
-		with open(self.path_to_config, 'w', encoding='utf-8') as f:
-			yaml.dump(self.input_data, f, allow_unicode=True)
-		logger.info('Input saved to disk')
+		'''Saves campaign parsing parameters to the state store, 
+		one key per platform'''
+
+		logger.info('Call to save config')
+		store = self.backend.store
+		store.write(
+			{('campaigns', pf): self.input_data[pf] for pf in self.input_data},
+			[('campaigns', pf) for pf in store.items('campaigns') if pf not in self.input_data]
+		)
+		logger.info('Input saved to state store')
 
 	def load_config(self):
-		'''Loads campaign parsing parameters'''
+		'''Loads campaign parsing parameters. The YAML config is migrated 
+		to the state store on first launch'''
 
 		logger.info('Call to load config')
-		if path.exists(self.path_to_config):
-			with open(self.path_to_config, 'r', encoding='utf-8') as y:
-				conf = yaml.safe_load(y)
-			logger.info(f'Config loaded {conf}')
-			return conf
-		logger.info('Returning empty config')
-		return {}
+		self.backend.store.migrate_yaml(self.path_to_config, 'campaigns')
+		conf = self.backend.store.items('campaigns')
+		logger.info(f'Config loaded {conf}')
+		return conf
 
 	def set_footer(self):
 		'''
@@ -755,38 +924,146 @@ class Program(Tk):
 		'''
 		
 		self.footer = Frame(self)
-		save_start_btn = Button(self.footer, text="Сохранить и Запустить",
+		self.save_start_btn = Button(self.footer, text="Сохранить и Запустить",
 			command=self.save_start_process_btn, padx=5)
 		save_btn = Button(self.footer, text="Сохранить",
 			command=self.save_btn, padx=5)
 		save_btn.grid(row=0, column=1, sticky='E', padx=5, pady=10)
-		save_start_btn.grid(row=0, column=2, sticky='E', padx=5, pady=10)
+		self.save_start_btn.grid(row=0, column=2, sticky='E', padx=5, pady=10)
 		self.footer.columnconfigure((0,), weight=1)
 		self.footer.grid(row=self.pf_count, column=0, pady=2, sticky='nsew') 
 
+		self.gs_warning = Label(self.footer, text="Не заданы настройки Google таблицы")
+		self.run_error_lbl = Label(self.footer)
+
 	def set_progress_bar(self):
 		'''
 		Sets up progress bar to track the execution of the main process 
 		in the backend
 		'''
-		# TO DO
-		pass
+		self.progress_status = Label(self.footer, text="Запуск...")
+		self.progress_bar = Progressbar(self.footer, mode='determinate')
+		self.cancel_btn = Button(self.footer, text="Отменить", 
+			command=self.cancel_run, padx=5)
+
+		self.progress_status.grid(row=1, column=0, sticky='W', padx=5)
+		self.progress_bar.grid(row=1, column=1, sticky='EW', padx=5, pady=5)
+		self.cancel_btn.grid(row=1, column=2, sticky='E', padx=5, pady=5)
+
+		# Campaigns of every platform plus writing to Google Spreadsheet
+		self.progress = {
+			'total': {pf: len(self.input_data[pf]) for pf in self.input_data},
+			'fetched': {pf: 0 for pf in self.input_data},
+			'finished': set(),
+			'written': 0,
+			# Rows written by the batches flushed so far
+			'batches': 0
+		}
+		self.progress_bar.config(maximum=sum(self.progress['total'].values()) + 1, value=0)
+
+	def update_progress_bar(self, event):
+		'''Moves progress bar according to an event received from the backend'''
+
+		p = self.progress
+		if event['event'] == 'platform_started':
+			self.progress_status.config(text=f"{event['platform']}...")
+		elif event['event'] == 'campaign_fetched':
+			p['fetched'][event['platform']] += 1
+		elif event['event'] == 'platform_finished':
+			p['finished'].add(event['platform'])
+		elif event['event'] == 'batch_written':
+			p['batches'] += event['rows']
+			self.progress_status.config(text=f"Записано строк: {p['batches']}")
+		elif event['event'] == 'sheet_written':
+			p['written'] = 1
+			self.progress_status.config(text="Данные записаны")
+
+		# Campaigns without data are only counted when their platform finishes
+		self.progress_bar.config(value=sum(
+			p['total'][pf] if pf in p['finished'] 
+			else min(p['fetched'][pf], p['total'][pf]) 
+			for pf in p['total']
+		) + p['written'])
+
+	def remove_progress_bar(self):
+		for widget in [self.progress_status, self.progress_bar, self.cancel_btn]:
+			widget.grid_forget()
+		self.save_start_btn.config(state='normal')
 
 	def save_start_process_btn(self):
 		logger.info('Saving values to dict and to disk')
 		self.save_values()
 		self.save_config()
-		self.set_progress_bar()
 		logger.info('Running main backend process')
 		logger.debug(f"Data given to backend: {self.input_data}")
-		self.gs_warning = Label(self.footer, text="Не заданы настройки Google таблицы")
 		if self.backend.gs_setting_complete():
 			self.gs_warning.grid_forget()
-			self.backend.run(self.input_data)
+			self.run_error_lbl.grid_forget()
+			self.save_start_btn.config(state='disabled')
+			self.set_progress_bar()
+
+			# Backend works in a separate thread and reports progress through
+			# the queue, which is polled by Tk main loop
+			self.progress_queue = Queue()
+			self.cancel_event = Event()
+			self.results_window = Results_window()
+			Thread(target=self.run_backend, args=(dict(self.input_data),), daemon=True).start()
+			self.after(100, self.poll_progress)
 		else:
 			self.gs_warning.grid(row=0, column=0, sticky='E', padx=5, pady=10)
-
-		Results_window(self.backend.get_result())
+			Results_window(self.backend.get_result())
+
+	def run_backend(self, input_data):
+		'''Runs backend process, executed in a worker thread'''
+
+		try:
+			self.backend.run(input_data, progress=self.progress_queue.put, 
+				cancel=self.cancel_event)
+			self.progress_queue.put({'event': 'done'})
+		except RunCancelled:
+			logger.info('Run cancelled by user')
+			self.progress_queue.put({'event': 'cancelled'})
+		except Exception as e:
+			logger.exception(e)
+			self.progress_queue.put({'event': 'failed', 'error': str(e)})
+
+	def poll_progress(self):
+		'''Applies progress events sent by the backend thread'''
+
+		while True:
+			try:
+				event = self.progress_queue.get_nowait()
+			except Empty:
+				break
+
+			if event['event'] in ('done', 'cancelled', 'failed'):
+				self.remove_progress_bar()
+				if event['event'] == 'failed':
+					self.run_error_lbl.config(text=f"Ошибка: {event['error']}")
+					self.run_error_lbl.grid(row=0, column=0, sticky='E', padx=5, pady=10)
+				if self.results_window.winfo_exists():
+					# Batches flushed before cancel or error stay in the sheet
+					written = self.progress['batches']
+					written_text = f"записано строк: {written}" if written else "данные не записаны"
+					self.results_window.finish({
+						'done': "Данные, записанные в Google таблицу:",
+						'cancelled': f"Запуск отменен, {written_text}",
+						'failed': f"Ошибка, {written_text}"
+					}[event['event']])
+				return
+
+			self.update_progress_bar(event)
+			if event['event'] == 'campaign_fetched' and self.results_window.winfo_exists():
+				self.results_window.add_row(
+					event['platform'], event['campaign_id'], event['data'])
+
+		self.after(100, self.poll_progress)
+
+	def cancel_run(self):
+		logger.info('Call to cancel run')
+		self.cancel_event.set()
+		self.cancel_btn.config(state='disabled')
+		self.progress_status.config(text="Отмена...")
 
 	def save_btn(self):
 		logger.info('Saving values to dict and to disk')
@@ -0,0 +1,118 @@
+'''Runs the main backend process without GUI, e.g. on a server by cron:
+
+	python headless.py [--campaigns campaigns.yml] [--dry-run] [--resume]
+
+Campaigns and Google Spreadsheet settings are the ones saved by the GUI
+to the state store, campaigns may also be given as a YAML file.
+A json summary of the run is printed to stdout, logs go to stderr.
+Exit codes: 0 - success, 1 - run failed, 2 - nothing to run'''
+
+import argparse
+import json
+import sys
+import yaml
+from backend import Backend
+from calendar import monthrange
+from datetime import date
+from loguru import logger
+from os import path
+from time import time
+
+
+# Campaigns config of the GUI before the state store, migrated on first run
+GUI_CAMPAIGNS_CONFIG = 'campaigns_config.yml'
+
+
+def load_campaigns(store, path_to_config=None):
+	'''Loads campaign parsing parameters saved by the GUI or, if the path
+	is given, from a YAML file'''
+
+	logger.info('Call to load config')
+	if path_to_config is None:
+		store.migrate_yaml(GUI_CAMPAIGNS_CONFIG, 'campaigns')
+		conf = store.items('campaigns')
+	elif not path.exists(path_to_config):
+		logger.info('Returning empty config')
+		return {}
+	else:
+		with open(path_to_config, 'r', encoding='utf-8') as y:
+			conf = yaml.safe_load(y) or {}
+
+	# Current month campaigns are saved with the dates of the month 
+	# they were saved in, a scheduled run needs the actual month
+	today = date.today()
+	month_dates = [
+		today.replace(day=1), 
+		today.replace(day=monthrange(today.year, today.month)[1])
+	]
+	for pf in conf:
+		for campaign in conf[pf]:
+			if campaign['period'] == 'Тек. месяц':
+				campaign['dates'] = month_dates
+
+	return conf
+
+
+def summarize(backend, input_data, written, started, dry_run=False):
+	'''Returns machine-readable summary of the run'''
+
+	result = backend.get_result()
+	return {
+		'status': 'ok',
+		'date': backend.today_date,
+		'duration': round(time() - started, 2),
+		'rows_written': written,
+		'dry_run': dry_run,
+		'changes': [
+			{k: v for k, v in change.items() if k != 'column_number'}
+			for change in backend.last_diff
+		],
+		'platforms': {
+			pf: {
+				'campaigns': len(input_data[pf]),
+				'collected': len(result.campaigns(pf)),
+				'missing': [c['id'] for c in input_data[pf] if (pf, c['id']) not in result]
+			}
+			for pf in input_data
+		}
+	}
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Collects ad statistics and '
+		'writes it to Google Spreadsheet without GUI')
+	parser.add_argument('--campaigns', 
+		help='YAML file with campaigns to run instead of the ones saved by the GUI')
+	parser.add_argument('--dry-run', action='store_true',
+		help='collect data and report cell changes without writing them')
+	parser.add_argument('--resume', action='store_true',
+		help='only redo campaigns the previous interrupted run did not complete')
+	args = parser.parse_args(argv)
+
+	started = time()
+	# No warm-up: it reads Chrome cookies, which VK-only runs do not need
+	# and servers usually do not have
+	backend = Backend(warm_up=False)
+	input_data = load_campaigns(backend.store, args.campaigns)
+
+	if not input_data or not backend.gs_setting_complete():
+		summary = {'status': 'not_configured', 
+			'error': 'No campaigns or Google Spreadsheet settings saved'}
+		exit_code = 2
+	else:
+		try:
+			written = backend.run(input_data, dry_run=args.dry_run, resume=args.resume)
+			summary = summarize(backend, input_data, written, started, args.dry_run)
+			exit_code = 0
+		except Exception as e:
+			logger.exception(e)
+			summary = {'status': 'error', 'error': repr(e), 
+				'duration': round(time() - started, 2)}
+			exit_code = 1
+
+	print(json.dumps(summary, ensure_ascii=False))
+	return exit_code
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,111 @@
+'''Per-campaign checkpoint journal of a run.
+
+Every campaign goes through 'fetched' (data collected from the platform),
+'normalized' (mapped to sheet cells) and 'written' (its cells are in the
+sheet). Each step is appended to a json lines file right away, so after a
+failed run the journal tells which campaigns are done and keeps the data
+of the fetched ones. A resumed run only redoes what did not complete.
+
+Records are only reused on the day they were made and for the same campaign
+settings (period, dates, indicators), other records are ignored.'''
+
+import json
+import os
+from datetime import date
+from loguru import logger
+from threading import Lock
+
+
+class RunJournal:
+
+	STATUSES = ['fetched', 'normalized', 'written']
+
+	def __init__(self, path):
+		self.path = path
+		self._lock = Lock()
+
+	@staticmethod
+	def campaign_key(pf, campaign):
+		'''Identifies campaign settings: a record made for other settings
+		must not be reused'''
+
+		return json.dumps([pf, campaign], sort_keys=True, ensure_ascii=False, default=str)
+
+	def start(self):
+		'''Starts a new journal, records of the previous run are dropped'''
+
+		with self._lock:
+			try:
+				open(self.path, 'w', encoding='utf-8').close()
+			except OSError as e:
+				logger.warning(f'Could not reset run journal: {e}')
+
+	def record(self, key, status, data=None):
+		'''Appends campaign status (and its data) to the journal'''
+		self.record_many([(key, status, data)])
+
+	def record_many(self, entries):
+		'''Appends (key, status, data) entries with a single write and fsync'''
+
+		if not entries:
+			return
+		today = date.today().isoformat()
+		lines = ''.join(
+			json.dumps({
+				'date': today,
+				'key': key,
+				'status': status,
+				'data': data
+			}, ensure_ascii=False, default=str) + '\n'
+			for key, status, data in entries
+		)
+		with self._lock:
+			try:
+				with open(self.path, 'a', encoding='utf-8') as f:
+					f.write(lines)
+					f.flush()
+					os.fsync(f.fileno())
+			except OSError as e:
+				logger.warning(f'Could not write run journal: {e}')
+
+	def load(self):
+		'''Returns {key: {'status', 'data'}} with the furthest status of every
+		campaign recorded today. Records of earlier days are dropped from 
+		the file, so a journal which is only resumed does not grow forever'''
+
+		today = date.today().isoformat()
+		state = {}
+		with self._lock:
+			try:
+				with open(self.path, 'r', encoding='utf-8') as f:
+					lines = f.readlines()
+			except OSError:
+				return state
+
+			kept = []
+			for line in lines:
+				try:
+					entry = json.loads(line)
+				except ValueError:
+					# The last line may be cut if the process was killed
+					continue
+				if entry.get('date') != today or entry.get('status') not in self.STATUSES:
+					continue
+				kept.append(line)
+				previous = state.get(entry['key'], {})
+				if self.STATUSES.index(entry['status']) >= self.STATUSES.index(
+						previous.get('status', 'fetched')):
+					state[entry['key']] = {
+						'status': entry['status'],
+						'data': entry['data'] if entry['data'] is not None else previous.get('data')
+					}
+
+			if len(kept) < len(lines):
+				tmp_path = f'{self.path}.tmp'
+				try:
+					with open(tmp_path, 'w', encoding='utf-8') as f:
+						f.writelines(kept)
+					os.replace(tmp_path, self.path)
+				except OSError as e:
+					logger.warning(f'Could not compact run journal: {e}')
+		return state
@@ -1,7 +1,13 @@
-from gui import Program
+import sys
 
 if __name__ == '__main__':
-		
+
+	# Headless mode never imports GUI modules
+	if '--headless' in sys.argv:
+		from headless import main
+		sys.exit(main([i for i in sys.argv[1:] if i != '--headless']))
+
+	from gui import Program
 	p = Program()
 	p.run()
-	
\ No newline at end of file
+	
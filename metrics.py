@@ -0,0 +1,122 @@
+'''Aggregation and storage of statistics collected from ad platforms.
+
+Daily rows (dicts as returned by platform APIs) are turned into columns 
+of floats, one array per metric, and every column is summed in one pass.
+Totals of all campaigns of a run are kept the same columnar way in
+MetricsStore.'''
+
+from array import array
+from loguru import logger
+from math import fsum, isnan, nan
+from operator import mul
+from sys import intern
+from threading import Lock
+
+
+# Indicators collected by the app
+METRICS = ['spent', 'impressions', 'clicks', 'reach', 'views', 'result']
+
+# Indicators counting events, the rest are money
+COUNTERS = {'impressions', 'clicks', 'reach', 'views', 'result'}
+
+
+def to_columns(rows, metrics, names=None, missing=0.0):
+	'''Returns {metric: array of floats} for the rows. names maps a metric 
+	to its key in the rows if they differ. A metric absent in a row or
+	empty is replaced with missing: 0.0 or nan'''
+
+	names = names or {}
+	columns = {m: array('d') for m in metrics}
+	for row in rows:
+		for m in metrics:
+			value = row.get(names.get(m, m))
+			columns[m].append(missing if value is None or value == '' else float(value))
+	return columns
+
+
+def aggregate(rows, metrics, names=None, missing=0.0):
+	'''Sums metrics over daily rows. Returns a dict of totals and a list of
+	metrics which are absent in every row (they are not in the totals). 
+	With missing=nan any day without a metric makes its total nan'''
+
+	names = names or {}
+	found = {m for row in rows for m in metrics if row.get(names.get(m, m)) not in (None, '')}
+	columns = to_columns(rows, [m for m in metrics if m in found], names, missing)
+
+	totals = {}
+	for m, column in columns.items():
+		total = fsum(column)
+		totals[m] = int(round(total)) if m in COUNTERS and not isnan(total) else total
+	return totals, [m for m in metrics if m not in found]
+
+
+def weighted_sum(values, weights):
+	'''Returns sum of values multiplied by weights element-wise'''
+	return fsum(map(mul, array('d', values), array('d', weights)))
+
+
+class MetricsStore:
+	'''Collected indicators of campaigns of all platforms. Every metric is 
+	an array of floats, a campaign is a row of them found by interned 
+	(platform, campaign ID), so campaigns of different platforms with the
+	same ID never overwrite each other. Values a campaign has no data of 
+	are nan. Safe to update from several threads'''
+
+	def __init__(self, metrics=METRICS):
+		self.metrics = list(metrics)
+		self.columns = {m: array('d') for m in self.metrics}
+		self.index = {}
+		self.keys = []
+		self._lock = Lock()
+
+	@staticmethod
+	def key(pf, campaign_id):
+		return intern(pf), intern(str(campaign_id))
+
+	def update(self, pf, campaign_id, indicators):
+		'''Sets the campaign's indicators, unknown and non-numeric ones are ignored'''
+
+		key = self.key(pf, campaign_id)
+		with self._lock:
+			row = self.index.get(key)
+			if row is None:
+				row = self.index[key] = len(self.keys)
+				self.keys.append(key)
+				for column in self.columns.values():
+					column.append(nan)
+			for m, value in indicators.items():
+				if m not in self.columns or value in (None, ''):
+					continue
+				try:
+					self.columns[m][row] = float(value)
+				except (TypeError, ValueError):
+					logger.debug(f'Not a number in {m} of {key}: {value!r}')
+
+	def get(self, pf, campaign_id):
+		'''Returns {metric: value} of the campaign, counters are ints'''
+
+		row = self.index.get((pf, str(campaign_id)))
+		if row is None:
+			return {}
+		indicators = {}
+		for m, column in self.columns.items():
+			value = column[row]
+			if not isnan(value):
+				indicators[m] = int(value) if m in COUNTERS else value
+		return indicators
+
+	def __contains__(self, key):
+		return (key[0], str(key[1])) in self.index
+
+	def __len__(self):
+		return len(self.keys)
+
+	def campaigns(self, pf):
+		'''Returns IDs of the platform's campaigns'''
+		return [campaign_id for key_pf, campaign_id in self.keys if key_pf == pf]
+
+	def items(self):
+		'''Yields ((platform, campaign ID), indicators) of every campaign'''
+
+		for pf, campaign_id in list(self.keys):
+			yield (pf, campaign_id), self.get(pf, campaign_id)
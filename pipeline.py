@@ -0,0 +1,114 @@
+'''Stages of the run pipeline: platform fetchers put their results into
+bounded queues, a normalization stage maps them to sheet cells and a
+batching writer sends the cells to Google Spreadsheet.
+
+Every stage is a thread reading its own queue, so a slow stage makes the
+previous one wait (the queue is bounded) instead of piling data up. An error
+in a stage is kept and re-raised by close; items put after it are dropped,
+so producers never block on a queue nobody reads.'''
+
+from queue import Queue, Empty
+from threading import Thread
+from time import monotonic
+
+
+_CLOSE = object()
+
+
+class Stage:
+
+	def __init__(self, name, handler, maxsize=100):
+		self.name = name
+		self.handler = handler
+		self.queue = Queue(maxsize)
+		self.error = None
+		self._thread = Thread(target=self._loop, name=name, daemon=True)
+
+	def start(self):
+		self._thread.start()
+		return self
+
+	def put(self, item):
+		self.queue.put(item)
+
+	def close(self):
+		'''Waits until all the items are handled, re-raises stage error'''
+
+		self.queue.put(_CLOSE)
+		self._thread.join()
+		if self.error is not None:
+			raise self.error
+
+	def timeout(self):
+		'''Seconds to wait for the next item before on_timeout is called'''
+		return None
+
+	def on_timeout(self):
+		pass
+
+	def on_close(self):
+		pass
+
+	def _loop(self):
+		while True:
+			try:
+				item = self.queue.get(timeout=self.timeout())
+			except Empty:
+				self._safe(self.on_timeout)
+				continue
+			if item is _CLOSE:
+				break
+			self._safe(self.handler, item)
+		self._safe(self.on_close)
+
+	def _safe(self, func, *args):
+		if self.error is not None:
+			return
+		try:
+			func(*args)
+		except BaseException as e:
+			self.error = e
+
+
+class BatchWriter(Stage):
+	'''Collects {row: {column: value}} cells and flushes them when batch_size
+	rows are collected or flush_interval seconds passed since the first
+	unflushed cell'''
+
+	def __init__(self, name, flush, batch_size=20, flush_interval=2.0, maxsize=100):
+		super().__init__(name, self._add, maxsize)
+		self.flush_func = flush
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.cells = {}
+		self.row_campaigns = {}
+		self._first_added = None
+
+	def _add(self, item):
+		cells, row_campaigns = item
+		for row in cells:
+			self.cells.setdefault(row, {}).update(cells[row])
+		self.row_campaigns.update(row_campaigns)
+		if self._first_added is None:
+			self._first_added = monotonic()
+		if len(self.cells) >= self.batch_size:
+			self.flush()
+
+	def timeout(self):
+		if self._first_added is None:
+			return None
+		return max(0, self._first_added + self.flush_interval - monotonic())
+
+	def on_timeout(self):
+		self.flush()
+
+	def on_close(self):
+		self.flush()
+
+	def flush(self):
+		if not self.cells:
+			return
+		cells, row_campaigns = self.cells, self.row_campaigns
+		self.cells, self.row_campaigns = {}, {}
+		self._first_added = None
+		self.flush_func(cells, row_campaigns)
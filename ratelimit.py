@@ -0,0 +1,92 @@
+'''Adaptive request rate governor for ad platforms and Google Sheets.
+
+Every request waits for a token from a token bucket (steady requests per 
+second with a burst) and for a free slot within a concurrency limit. The
+limit is adjusted by AIMD: it grows by one slot per limit's worth of 
+successful requests and is halved when the platform throttles us, in 
+which case the request is retried after Retry-After or exponential backoff.'''
+
+from loguru import logger
+from threading import Condition
+from time import monotonic, sleep
+
+
+class RateGovernor:
+
+	def __init__(self, name, rate, burst=None, max_concurrency=4, 
+			min_concurrency=1, retries=5, backoff=1.0):
+		self.name = name
+		self.rate = float(rate)
+		self.capacity = float(burst or max(1, rate))
+		self.tokens = self.capacity
+		self.updated = monotonic()
+		self.blocked_until = 0
+
+		self.max_concurrency = max_concurrency
+		self.min_concurrency = min_concurrency
+		self.limit = float(max_concurrency)
+		self.active = 0
+
+		self.retries = retries
+		self.backoff = backoff
+		self.cond = Condition()
+
+	def acquire(self):
+		'''Waits for a concurrency slot and a token'''
+
+		with self.cond:
+			while self.active >= int(self.limit):
+				self.cond.wait()
+			self.active += 1
+
+		while True:
+			with self.cond:
+				now = monotonic()
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				wait = self.blocked_until - now
+				if wait <= 0:
+					if self.tokens >= 1:
+						self.tokens -= 1
+						return
+					wait = (1 - self.tokens) / self.rate
+			sleep(wait)
+
+	def release(self, throttled=False, retry_after=None):
+		'''Frees the slot and adapts the concurrency limit'''
+
+		with self.cond:
+			self.active -= 1
+			if throttled:
+				self.limit = max(self.min_concurrency, self.limit / 2)
+				self.tokens = 0
+				if retry_after:
+					self.blocked_until = max(self.blocked_until, monotonic() + retry_after)
+				logger.debug(f'{self.name} throttled, concurrency limit {int(self.limit)}')
+			else:
+				self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+			self.cond.notify_all()
+
+	def call(self, func, check_result=None, check_error=None):
+		'''Calls func() through the governor. check_result(result) and 
+		check_error(exception) return None if the platform did not throttle 
+		the request, otherwise seconds to wait before retrying (0 if unknown).
+		After the last retry the result is returned or the error is raised'''
+
+		for attempt in range(self.retries + 1):
+			self.acquire()
+			try:
+				result = func()
+			except Exception as e:
+				retry_after = check_error(e) if check_error else None
+				self.release(throttled=retry_after is not None, retry_after=retry_after)
+				if retry_after is None or attempt == self.retries:
+					raise
+			else:
+				retry_after = check_result(result) if check_result else None
+				self.release(throttled=retry_after is not None, retry_after=retry_after)
+				if retry_after is None or attempt == self.retries:
+					return result
+
+			if not retry_after:
+				sleep(self.backoff * 2 ** attempt)
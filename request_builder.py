@@ -0,0 +1,41 @@
+'''Immutable requests to ad platforms.
+
+Static headers and params of a request are read from the config and
+compiled into a template once. Every request gets its own spec built from
+the template and per request values, nothing is changed in place, so
+requests may be built and sent from several threads and per request values
+never end up in the saved config.'''
+
+from collections import namedtuple
+from types import MappingProxyType
+
+
+RequestSpec = namedtuple('RequestSpec', ['method', 'url', 'headers', 'params'])
+
+
+class RequestTemplate:
+
+	def __init__(self, method, url, headers=None, params=None, volatile=()):
+		'''volatile are per request keys, dropped from static headers and params'''
+
+		self.method = method
+		self.url = url
+		self.headers = MappingProxyType(
+			{k: v for k, v in (headers or {}).items() if k not in volatile})
+		self.params = MappingProxyType(
+			{k: v for k, v in (params or {}).items() if k not in volatile})
+
+	@classmethod
+	def from_config(cls, method, url, config, volatile=()):
+		return cls(method, url, config.get('headers'), config.get('params'), volatile)
+
+	def build(self, params=None, headers=None, url=None, **url_args):
+		'''Returns a new spec: static values updated with the given ones,
+		url is formatted with url_args'''
+
+		return RequestSpec(
+			self.method,
+			(url or self.url).format(**url_args),
+			MappingProxyType({**self.headers, **(headers or {})}),
+			MappingProxyType({**self.params, **(params or {})})
+		)
@@ -0,0 +1,87 @@
+'''On-disk cache of ad platforms' responses.
+
+Entries are keyed by a normalized request: platform, account, campaign, 
+date range and so on. Statistics of a date range closed long ago never 
+change, so such entries are kept permanently, others expire after a short
+TTL. The number of entries is limited, least recently used ones are 
+evicted first.'''
+
+import os
+import pickle
+from hashlib import sha1
+from loguru import logger
+from time import time
+
+
+class ResponseCache:
+
+	def __init__(self, directory, ttl=900, max_entries=5000):
+		self.directory = directory
+		self.ttl = ttl
+		self.max_entries = max_entries
+		os.makedirs(directory, exist_ok=True)
+
+	def _path(self, key):
+		return os.path.join(self.directory, sha1(repr(key).encode('utf-8')).hexdigest())
+
+	def get(self, key):
+		'''Returns cached value or None if there is no valid entry'''
+
+		file_path = self._path(key)
+		try:
+			with open(file_path, 'rb') as f:
+				expires, value = pickle.load(f)
+		except (OSError, EOFError, pickle.UnpicklingError):
+			return None
+
+		if expires is not None and expires < time():
+			self._remove(file_path)
+			return None
+
+		# Modification time is used to evict least recently used entries
+		try:
+			os.utime(file_path)
+		except OSError:
+			pass
+		return value
+
+	def set(self, key, value, permanent=False):
+		'''Stores the value, permanently or for TTL seconds'''
+
+		file_path = self._path(key)
+		tmp_path = f'{file_path}.{os.getpid()}.tmp'
+		try:
+			with open(tmp_path, 'wb') as f:
+				pickle.dump((None if permanent else time() + self.ttl, value), f)
+			os.replace(tmp_path, file_path)
+		except OSError as e:
+			logger.debug(f'Could not write response cache entry: {e}')
+			self._remove(tmp_path)
+
+	def evict(self):
+		'''Removes expired entries and least recently used ones above the limit'''
+
+		entries = []
+		for name in os.listdir(self.directory):
+			file_path = os.path.join(self.directory, name)
+			try:
+				with open(file_path, 'rb') as f:
+					expires, _ = pickle.load(f)
+				mtime = os.path.getmtime(file_path)
+			except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+				self._remove(file_path)
+				continue
+			if expires is not None and expires < time():
+				self._remove(file_path)
+			else:
+				entries.append((mtime, file_path))
+
+		entries.sort()
+		for _, file_path in entries[:max(0, len(entries) - self.max_entries)]:
+			self._remove(file_path)
+
+	def _remove(self, file_path):
+		try:
+			os.remove(file_path)
+		except OSError:
+			pass
@@ -0,0 +1,102 @@
+'''Local state of the app in SQLite: backend config, campaign rows of the
+sheet, credentials, caches and campaign definitions saved by the GUI.
+
+Values are kept key by key in namespaces, so saving one changed key does
+not rewrite the whole state as YAML files did. The database is in WAL mode
+and every write is a transaction, so GUI and headless processes may use it
+at the same time: readers never wait for writers and a write either
+happens completely or not at all.'''
+
+import pickle
+import sqlite3
+import yaml
+from loguru import logger
+from os import path
+from threading import Lock
+from time import time
+
+
+class StateStore:
+
+	def __init__(self, path_to_db):
+		self.path = path_to_db
+		self._lock = Lock()
+		self._conn = sqlite3.connect(path_to_db, timeout=30,
+			check_same_thread=False, isolation_level=None)
+		self._conn.execute('PRAGMA journal_mode=WAL')
+		self._conn.execute('PRAGMA synchronous=NORMAL')
+		self._conn.execute(
+			'CREATE TABLE IF NOT EXISTS state ('
+			'namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB, updated REAL, '
+			'PRIMARY KEY (namespace, key))'
+		)
+
+	def get(self, namespace, key, default=None):
+		with self._lock:
+			row = self._conn.execute(
+				'SELECT value FROM state WHERE namespace = ? AND key = ?',
+				(namespace, str(key))
+			).fetchone()
+		return pickle.loads(row[0]) if row else default
+
+	def items(self, namespace):
+		'''Returns all the keys of a namespace as a dict'''
+
+		with self._lock:
+			rows = self._conn.execute(
+				'SELECT key, value FROM state WHERE namespace = ? ORDER BY rowid',
+				(namespace,)
+			).fetchall()
+		return {key: pickle.loads(value) for key, value in rows}
+
+	def set(self, namespace, key, value):
+		self.write({(namespace, key): value})
+
+	def delete(self, namespace, key):
+		self.write({}, [(namespace, key)])
+
+	def clear(self, namespace):
+		'''Deletes all the keys of a namespace'''
+
+		with self._lock:
+			if self._conn.execute(
+					'SELECT 1 FROM state WHERE namespace = ? LIMIT 1', (namespace,)).fetchone():
+				self._conn.execute('DELETE FROM state WHERE namespace = ?', (namespace,))
+
+	def write(self, values, deleted=()):
+		'''Sets {(namespace, key): value} and deletes (namespace, key) pairs
+		in one transaction'''
+
+		now = time()
+		rows = [(ns, str(key), pickle.dumps(value), now) for (ns, key), value in values.items()]
+		with self._lock:
+			# Waits up to the timeout while another process writes, a failure
+			# here leaves no transaction to roll back
+			self._conn.execute('BEGIN IMMEDIATE')
+			try:
+				self._conn.executemany(
+					'INSERT OR REPLACE INTO state (namespace, key, value, updated) '
+					'VALUES (?, ?, ?, ?)', rows
+				)
+				self._conn.executemany(
+					'DELETE FROM state WHERE namespace = ? AND key = ?',
+					[(ns, str(key)) for ns, key in deleted]
+				)
+				self._conn.execute('COMMIT')
+			except BaseException:
+				if self._conn.in_transaction:
+					self._conn.execute('ROLLBACK')
+				raise
+
+	def migrate_yaml(self, path_to_yaml, namespace):
+		'''Copies top level keys of a YAML file to the namespace once.
+		The file is left as is, but it is not read after that'''
+
+		if self.get('migrations', path_to_yaml) or not path.exists(path_to_yaml):
+			return
+		with open(path_to_yaml, 'r', encoding='utf-8') as y:
+			conf = yaml.safe_load(y) or {}
+		values = {(namespace, key): value for key, value in conf.items()}
+		values[('migrations', path_to_yaml)] = time()
+		self.write(values)
+		logger.info(f'{path_to_yaml} migrated to the state store')
@@ -0,0 +1,45 @@
+from datetime import date
+
+from campaign_import import parse_campaigns
+
+
+def test_tsv_with_commas_in_indicators():
+	result = parse_campaigns('123\tspent,clicks\t01.10.2026\t31.10.2026', False)
+	assert result.errors == []
+	[campaign] = result.campaigns
+	assert campaign['id'] == '123'
+	assert campaign['spent'] and campaign['clicks'] and not campaign['reach']
+	assert campaign['period'] == 'Даты'
+	assert campaign['dates'] == [date(2026, 10, 1), date(2026, 10, 31)]
+
+
+def test_tsv_with_client_id_and_header():
+	text = (
+		'Клиент\tID кампании\tПоказатели\tНачало\tКонец\n'
+		'555\t123\tПоказы, Охват\t2026-10-01\t2026-10-31\n'
+		'555\t124\t\t\t\n'
+	)
+	result = parse_campaigns(text, True)
+	assert result.errors == []
+	first, second = result.campaigns
+	assert first['client_id'] == '555'
+	assert first['impressions'] and first['reach'] and not first['spent']
+	assert second['period'] == 'Тек. месяц'
+	assert second['spent'] and not second['views']
+
+
+def test_csv_without_header():
+	text = '123,spent,01.10.2026,31.10.2026\n124,clicks,01.10.2026,31.10.2026'
+	result = parse_campaigns(text, False)
+	assert result.errors == []
+	assert [c['id'] for c in result.campaigns] == ['123', '124']
+	assert result.campaigns[1]['clicks'] and not result.campaigns[1]['spent']
+
+
+def test_semicolon_csv_with_indicator_columns():
+	text = 'id;spent;clicks\n123;1;0\n123;1;1\nabc;1;1'
+	result = parse_campaigns(text, False)
+	assert len(result.campaigns) == 1
+	assert result.campaigns[0]['spent'] and not result.campaigns[0]['clicks']
+	assert result.duplicates == 1
+	assert len(result.errors) == 1 and 'Строка 4' in result.errors[0]
@@ -0,0 +1,130 @@
+import re
+
+import pytest
+
+pytest.importorskip('pygsheets')
+pytest.importorskip('requests')
+pytest.importorskip('browser_cookie3')
+pytest.importorskip('loguru')
+
+from backend import Backend
+
+
+def parse_a1(addr):
+	letters, digits = re.fullmatch(r'([A-Z]+)(\d+)', addr).groups()
+	column = 0
+	for letter in letters:
+		column = column * 26 + ord(letter) - ord('A') + 1
+	return int(digits), column
+
+
+class FakeWorksheet:
+	'''Sheet of {(row, column): value}. Values are returned as written, like
+	unformatted values of numbers and formatted strings of dates'''
+
+	def __init__(self, cells=None):
+		self.cells = dict(cells or {})
+		self.updates = []
+
+	def _bounds(self, a1_range):
+		first, last = a1_range.split(':')
+		return parse_a1(first), parse_a1(last)
+
+	def get_values_batch(self, ranges, **kwargs):
+		result = []
+		for a1_range in ranges:
+			(first_row, first_column), (last_row, last_column) = self._bounds(a1_range)
+			result.append([
+				[self.cells.get((row, column), '') for column in range(first_column, last_column + 1)]
+				for row in range(first_row, last_row + 1)
+			])
+		return result
+
+	def update_values_batch(self, ranges, values, parse=True):
+		self.updates.append(ranges)
+		for a1_range, block in zip(ranges, values):
+			(first_row, first_column), _ = self._bounds(a1_range)
+			for i, row_values in enumerate(block):
+				for j, value in enumerate(row_values):
+					self.cells[(first_row + i, first_column + j)] = value
+
+	def get_col(self, column, include_tailing_empty=False):
+		last_row = max(row for row, col in self.cells if col == column)
+		return [self.cells.get((row, column), '') for row in range(1, last_row + 1)]
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+	(tmp_path / 'config').mkdir()
+	(tmp_path / 'app').mkdir()
+	monkeypatch.chdir(tmp_path / 'app')
+
+	backend = Backend(warm_up=False)
+	backend.config['GS'] = {
+		'spreadsheet_id': 'test',
+		'sheet_name': 'test',
+		'columns': {
+			'id': {'name': 'ID', 'column_number': 1},
+			'date': {'name': 'Дата', 'column_number': 2},
+			'spent': {'name': 'Потрачено', 'column_number': 3},
+			'impressions': {'name': 'Показы', 'column_number': 4},
+			'clicks': {'name': 'Клики', 'column_number': 5}
+		}
+	}
+	backend.ws = FakeWorksheet({
+		(1, 1): 'ID', (2, 1): '101', (3, 1): '102', (4, 1): '103', (6, 1): '105'
+	})
+	return backend
+
+
+def test_cells_to_ranges_merges_rectangles(backend):
+	cells = {
+		2: {3: 1, 4: 2, 6: 3},
+		3: {3: 4, 4: 5},
+		5: {3: 6, 4: 7}
+	}
+	ranges, values, origins = backend._cells_to_ranges(cells)
+	assert ranges == ['C2:D3', 'F2:F2', 'C5:D5']
+	assert values == [[[1, 2], [4, 5]], [[3]], [[6, 7]]]
+	assert origins == [(2, 3), (2, 6), (5, 3)]
+
+
+def test_same_value(backend):
+	assert backend._same_value(1000, '1000')
+	assert backend._same_value(1234.56, 1234.56)
+	assert backend._same_value(1234.561, 1234.56)
+	assert not backend._same_value(1, 1000)
+	assert backend._same_value('1000', 1000)
+	assert not backend._same_value('1,000', 1)
+	assert backend._same_value('18.10.2026', '18.10.2026')
+	assert not backend._same_value('17.10.2026', '18.10.2026')
+	assert not backend._same_value('', 0)
+
+
+def test_unchanged_rerun_writes_nothing(backend):
+	backend.metrics.update('MyTarget', '101', {'spent': '10.5', 'impressions': '100', 'clicks': '3'})
+	backend.metrics.update('MyTarget', '102', {'spent': '20', 'impressions': '200'})
+	backend.metrics.update('MyTarget', '104', {'spent': '1'})
+
+	assert backend.write_to_gspread() == 2
+	assert backend.ws.updates
+	assert backend.ws.cells[(2, 3)] == 10.5
+	assert backend.ws.cells[(3, 4)] == 200
+	assert backend.ws.cells[(2, 2)] == backend.today_date
+
+	backend.ws.updates.clear()
+	assert backend.write_to_gspread(dry_run=True) == 0
+	assert backend.last_diff == []
+	assert backend.write_to_gspread() == 0
+	assert backend.ws.updates == []
+
+
+def test_dry_run_reports_changes_without_writing(backend):
+	backend.ws.cells[(2, 3)] = 5
+	backend.metrics.update('MyTarget', '101', {'spent': 7})
+
+	assert backend.write_to_gspread(dry_run=True) == 1
+	assert backend.ws.updates == []
+	changes = {(c['column'], c['old'], c['new']) for c in backend.last_diff}
+	assert ('Потрачено', 5, 7.0) in changes
+	assert ('Дата', '', backend.today_date) in changes